@@ -0,0 +1,146 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Analog axis calibration.
+
+Fits `AbsEventHandler` thresholds and velocity coefficient to a recording
+of a burst of hits. NumPy is used when available.
+"""
+
+import logging
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger("calibration")
+
+# part of the axis range around the rest position considered noise
+NOISE_BAND = 0.05
+
+# levels of the thresholds between the noise and the softest hit peak
+THRES_HIGH_LEVEL = 0.5
+THRES_LOW_LEVEL = 0.25
+
+# rise rate percentile mapped to the maximum velocity
+RATE_PERCENTILE = 90
+
+Calibration = namedtuple("Calibration", "thres_low thres_high velocity_coeff"
+                                        " hits noise peaks")
+
+def _percentile(values, percent):
+    """Return percentile of a non-empty sequence (nearest rank)."""
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def _find_hits_numpy(times, values, level):
+    """Return peak values and rise rates of hits (runs of values above
+    `level`), NumPy version."""
+    times = numpy.asarray(times, dtype=float)
+    values = numpy.asarray(values, dtype=float)
+    above = values > level
+    # run boundaries: +1 where a run starts, -1 after it ends
+    edges = numpy.diff(numpy.concatenate(([0], above.astype(int), [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    if not len(starts):
+        return [], []
+    peaks = numpy.maximum.reduceat(values, starts)
+    # the first hit may have started before the recording
+    prev = numpy.maximum(starts - 1, 0)
+    dt = times[starts] - times[prev]
+    dv = values[starts] - values[prev]
+    valid = (starts > 0) & (dt > 0)
+    rates = dv[valid] / dt[valid]
+    return peaks.tolist(), rates.tolist()
+
+def _find_hits_python(times, values, level):
+    """Return peak values and rise rates of hits (runs of values above
+    `level`)."""
+    peaks = []
+    rates = []
+    peak = None
+    for i, value in enumerate(values):
+        if value > level:
+            if peak is None:
+                peak = value
+                if i > 0 and times[i] > times[i - 1]:
+                    rates.append((value - values[i - 1])
+                                 / (times[i] - times[i - 1]))
+            else:
+                peak = max(peak, value)
+        elif peak is not None:
+            peaks.append(peak)
+            peak = None
+    if peak is not None:
+        peaks.append(peak)
+    return peaks, rates
+
+def analyze_hits(samples, abs_min, abs_max):
+    """Fit axis settings to recorded hits.
+
+    `samples` is a list of (timestamp, value) tuples of a single axis
+    resting at `abs_min`. Thresholds are returned in per cent of the axis
+    range, `velocity_coeff` maps fast hits to the full velocity.
+
+    Return Calibration tuple or None if no hits were found.
+    """
+    abs_range = float(abs_max - abs_min)
+    if not samples or abs_range <= 0:
+        return None
+    times = [sample[0] for sample in samples]
+    values = [sample[1] for sample in samples]
+    rest = _percentile(values, 5)
+    near_rest = [value for value in values
+                 if value <= rest + NOISE_BAND * abs_range]
+    noise = max(near_rest) if near_rest else rest
+    if max(values) <= noise:
+        return None
+    level = noise + NOISE_BAND * abs_range
+    if numpy is not None:
+        peaks, rates = _find_hits_numpy(times, values, level)
+    else:
+        peaks, rates = _find_hits_python(times, values, level)
+    if not peaks:
+        return None
+    softest = min(peaks)
+    thres_high = noise + THRES_HIGH_LEVEL * (softest - noise)
+    thres_low = noise + THRES_LOW_LEVEL * (softest - noise)
+    # AbsEventHandler velocity: axis range fractions per second * coeff
+    rates = [rate / abs_range for rate in rates if rate > 0]
+    if rates:
+        velocity_coeff = 127.0 / _percentile(rates, RATE_PERCENTILE)
+    else:
+        velocity_coeff = None
+    def to_percent(value):
+        return (value - abs_min) * 100.0 / abs_range
+    logger.debug("noise: %r, peaks: %r, rates: %r", noise, peaks, rates)
+    return Calibration(to_percent(thres_low), to_percent(thres_high),
+                       velocity_coeff, len(peaks), to_percent(noise),
+                       [to_percent(peak) for peak in peaks])
@@ -0,0 +1,126 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Control socket for a running instance.
+
+Commands are sent one per line, each is answered with a single line:
+`ok`, `ok <details>` or `error <reason>`. Available commands are defined
+by the application, e.g.::
+
+    $ echo reload | socat - UNIX-CONNECT:badumtss.sock
+    ok
+"""
+
+import asyncio
+import logging
+
+from collections import deque
+
+from .util import start_stream_server
+
+logger = logging.getLogger("controlserver")
+
+MAX_LINE = 1024
+
+class ControlProtocol(asyncio.Protocol):
+    """Line based command protocol.
+
+    `commands` maps command names to functions or coroutine functions,
+    called with the command arguments. The result (if not None) is
+    appended to the `ok` reply. Commands from a connection are executed
+    in order.
+    """
+    def __init__(self, loop, commands):
+        self._loop = loop
+        self._commands = commands
+        self._transport = None
+        self._data = b""
+        self._lines = deque()
+        self._task = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        self._transport = None
+
+    def data_received(self, data):
+        self._data += data
+        *lines, self._data = self._data.split(b"\n")
+        if len(self._data) > MAX_LINE:
+            self._transport.close()
+            return
+        for line in lines:
+            line = line.strip()
+            if line:
+                self._lines.append(line.decode("utf-8", "replace"))
+        if self._lines and self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._lines:
+                reply = await self._execute(self._lines.popleft())
+                if self._transport is None:
+                    return
+                self._transport.write(reply.encode("utf-8") + b"\n")
+        finally:
+            self._task = None
+
+    async def _execute(self, line):
+        name, *args = line.split()
+        func = self._commands.get(name)
+        if func is None:
+            return "error unknown command: {}".format(name)
+        logger.info("Control command: %r", line)
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except Exception as err:
+            logger.warning("Control command %r failed: %s", line, err)
+            logger.debug("Exception:", exc_info=True)
+            return "error {}".format(err)
+        if result is None:
+            return "ok"
+        return "ok {}".format(result)
+
+def start_control_server(config, loop, commands):
+    """Start control server if configured in the `[control]` section.
+
+    Return the asyncio Server object or None.
+    """
+    if "control" not in config:
+        return None
+    section = config["control"]
+    if section.getboolean("disabled", False):
+        return None
+    listen = section.get("listen", "unix:badumtss.sock")
+    factory = lambda: ControlProtocol(loop, commands)
+    server = start_stream_server(loop, factory, listen, "control")
+    if server is None:
+        return None
+    logger.info("Accepting control commands on %r", listen)
+    return server
@@ -25,6 +25,7 @@
 
 """Input device interface."""
 
+import asyncio
 import logging
 
 from importlib import import_module
@@ -33,7 +34,7 @@ from .base import InputDeviceLoadError, UnknownDeviceTypeError
 
 logger = logging.getLogger("input")
 
-DRIVERS = {"evdev", "terminal", "gtk"}
+DRIVERS = {"evdev", "terminal", "gtk", "net", "jack_midi"}
 
 loaded_drivers = {}
 
@@ -74,6 +75,34 @@ def probe_input_drivers(config):
                 continue
         loaded_drivers[driver_name] = module
 
+async def probe_input_devices(config, loop, section=None, sections=None):
+    """Let the drivers look for their devices in worker threads.
+
+    The devices are used by the following `input_devices_generator` call.
+    Blocking device probing done in advance lets other tasks (like the
+    intro) run meanwhile.
+
+    If `sections` is given, only those sections are probed.
+    """
+    if sections is None:
+        sections = [name for name in config
+                    if not config[name].getboolean("disabled", False)]
+    else:
+        sections = list(sections)
+    if section and section not in sections:
+        sections.append(section)
+    futures = []
+    for name in sections:
+        module = loaded_drivers.get(name.split(":", 1)[0])
+        if module is None or not hasattr(module, "probe_input_devices"):
+            continue
+        futures.append(loop.run_in_executor(None, module.probe_input_devices,
+                                            config, name))
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Device probing failed: %s", result)
+
 def input_devices_generator_single(config, section, loop):
     """Create input device handlers from a single configuration section.
 
@@ -25,13 +25,39 @@
 
 import logging
 import os
+import time
 
+from array import array
 from configparser import ConfigParser, ExtendedInterpolation
 
+from .. import metrics
 from .. import midi
+from .transform import compile_note_table, TransformError
 
 logger = logging.getLogger("input.base")
 
+# keymap layer switching modes
+LAYER_MODES = ("momentary", "latch", "select")
+
+# keymap section for defaults of a layer: `[layer:NAME]`
+LAYER_SECTION_PREFIX = "layer:"
+
+# separator of input name and layer name in keymap sections: `[KEY_A@NAME]`
+LAYER_SEPARATOR = "@"
+
+# default section name used when reading the raw keymap, so the `defaults`
+# section is not merged into the other ones
+_RAW_DEFAULT_SECTION = "\0defaults"
+
+def split_layer_section(section):
+    """Split keymap section name into input name and layer name."""
+    name, sep, layer = section.partition(LAYER_SEPARATOR)
+    if name and layer:
+        return name, layer
+    else:
+        # e.g. the '@' key
+        return section, ""
+
 class InputDeviceError(Exception):
     """Raised on input device errors."""
     pass
@@ -45,15 +71,82 @@ class UnknownDeviceTypeError(InputDeviceLoadError):
     pass
 
 class EventHandler(object):
-    """Process input events and translate them to MIDI or control messages."""
+    """Process input events and translate them to MIDI or control messages.
+
+    Notes are released automatically `duration` milliseconds after note on,
+    if it is set. All time settings are in milliseconds.
+
+    Hits (note on events) may be filtered: `retrigger` is the minimum time
+    (in milliseconds) between hits of the binding, a hit on a binding
+    with `crosstalk` set (a comma-separated list of other bindings)
+    suppresses hits on those bindings for `crosstalk_time` milliseconds,
+    unless their velocity is higher than `crosstalk_ratio` times the
+    velocity of the hit. Event timestamps are used for the checks.
+    """
     def __init__(self, device, key, settings):
         self._device = device
         self._settings = settings
+        self._note = None
+        self._note_table = None
+        self._sounding = {}
+        self._off_timers = {}
+        self._suppressed = set()
+        self._channel = int(settings.get("channel", 1))
+        self._duration = float(settings.get("duration", 0) or 0) / 1000.0
+        self._slot = None
+        self._retrigger = float(settings.get("retrigger", 0) or 0) / 1000.0
+        self._crosstalk = ()
+        self._crosstalk_names = tuple(name.strip() for name
+                                      in settings.get("crosstalk",
+                                                      "").split(",")
+                                      if name.strip())
+        self._crosstalk_time = float(settings.get("crosstalk_time",
+                                                  20)) / 1000.0
+        self._crosstalk_ratio = float(settings.get("crosstalk_ratio", 1.0))
+        self._layer = settings.get("layer")
+        self._layer_mode = settings.get("layer_mode", "momentary")
+        if self._layer_mode not in LAYER_MODES:
+            logger.warning("[%s]: unknown layer_mode: %r", settings.name,
+                           self._layer_mode)
+            self._layer_mode = "momentary"
+        if (self._layer is not None and self._layer_mode == "momentary"
+                and not device.release_events):
+            # the layer would never be released
+            logger.warning("[%s]: %s reports no key releases, using"
+                           " layer_mode=latch", settings.name, device.name)
+            self._layer_mode = "latch"
+        # checked once here, not for every event
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        if "note" in settings:
+            try:
+                self._note_table = compile_note_table(settings)
+            except (TransformError, ValueError) as err:
+                logger.warning("[%s]: %s", settings.name, err)
+                return
+            if settings["note"] != "varies":
+                self._note = int(settings["note"])
+
+    def assign_slots(self):
+        """Look up the hit filtering state slots of the binding and its
+        crosstalk targets.
+
+        May grow the device state arrays, so must be called in the event
+        loop thread."""
+        if self._note_table is None:
+            return
+        device = self._device
+        self._slot = device.binding_slot(self._settings.name)
+        self._crosstalk = tuple(device.binding_slot(name)
+                                for name in self._crosstalk_names)
 
     def get_velocity(self):
         """Return velocity for current event."""
         return int(self._settings["velocity"])
 
+    def get_timestamp(self, event):
+        """Return capture time of an event (in the `time.time()` domain)."""
+        return time.time()
+
     def get_note(self):
         """Return note for current event.
         
@@ -74,26 +167,182 @@ class EventHandler(object):
 
         The `event` is an opaque object to be interpreted by classes derived
         from EventHandler.
+
+        Return a message, a list of messages or None.
         """
         interpret_event = self.interpret_event(event)
         if interpret_event == "ignore":
             return None
-        if "note" in self._settings:
-            note = self._settings["note"]
-            if note == "varies":
-                note = self.get_note()
+        if self._layer is not None:
+            msgs = self._device.switch_layer(self._layer, self._layer_mode,
+                                             interpret_event == "on")
+            return msgs or None
+        if self._note_table is None:
+            return None
+        base_note = self._note
+        if base_note is None:
+            base_note = self.get_note()
+        velocity = self.get_velocity()
+        if velocity > 127:
+            velocity = 127
+        elif velocity < 0:
+            velocity = 0
+        timestamp = self.get_timestamp(event)
+        channel = self._channel
+        if interpret_event == "on":
+            if self._slot is not None and self._filter_hit(timestamp,
+                                                           velocity):
+                self._suppressed.add(base_note)
+                return None
+            msgs = [midi.NoteOn(channel, note, out_velocity, timestamp)
+                    for note, out_velocity
+                    in self._get_notes(base_note, velocity)]
+            self._sounding[base_note] = (channel, [msg.note for msg in msgs])
+            if self._debug:
+                logger.debug("  note on: %r", msgs)
+            if self._duration:
+                self._schedule_note_off(base_note)
+        elif interpret_event == "off":
+            if base_note in self._suppressed:
+                self._suppressed.discard(base_note)
+                if base_note not in self._sounding:
+                    return None
+            timer = self._off_timers.pop(base_note, None)
+            if timer is not None:
+                timer.cancel()
+            sounding = self._sounding.pop(base_note, None)
+            if sounding is None:
+                notes = [note for note, out_velocity
+                         in self._get_notes(base_note, velocity)]
             else:
-                note = int(note)
-            channel = int(self._settings["channel"])
-            velocity = self.get_velocity()
-            if interpret_event == "on":
-                logger.debug("  note on: %r, %r, %r", channel, note, velocity)
-                return midi.NoteOn(channel, note, velocity)
-            elif interpret_event == "off":
-                logger.debug("  note off: %r, %r, %r", channel, note, velocity)
-                return midi.NoteOff(channel, note, velocity)
+                channel, notes = sounding
+            msgs = [midi.NoteOff(channel, note, velocity, timestamp)
+                    for note in notes]
+            if self._debug:
+                logger.debug("  note off: %r", msgs)
         else:
             return None
+        if len(msgs) == 1:
+            return msgs[0]
+        elif msgs:
+            return msgs
+        else:
+            return None
+
+    def _get_notes(self, base_note, velocity):
+        """Return (note, velocity) pairs to play for `base_note` and input
+        `velocity`.
+
+        Relative notes out of the MIDI range are dropped."""
+        result = []
+        for relative, note, out_velocity in self._note_table[velocity]:
+            if relative:
+                note += base_note
+                if not 0 <= note <= 127:
+                    continue
+            result.append((note, out_velocity))
+        return result
+
+    def _filter_hit(self, timestamp, velocity):
+        """Check a hit against the retrigger and crosstalk limits.
+
+        Return True if the hit should be dropped."""
+        device = self._device
+        slot = self._slot
+        if (self._retrigger
+                and timestamp - device.hit_times[slot] < self._retrigger):
+            device.retrigger_metric.inc()
+            return True
+        if (timestamp < device.suppress_until[slot]
+                and velocity <= device.suppress_velocity[slot]):
+            device.crosstalk_metric.inc()
+            return True
+        device.hit_times[slot] = timestamp
+        if self._crosstalk:
+            until = timestamp + self._crosstalk_time
+            threshold = velocity * self._crosstalk_ratio
+            suppress_until = device.suppress_until
+            suppress_velocity = device.suppress_velocity
+            for target in self._crosstalk:
+                # a weaker hit neither shortens nor extends the suppression
+                # window of a stronger one
+                if (suppress_until[target] < timestamp
+                        or suppress_velocity[target] <= threshold):
+                    suppress_velocity[target] = threshold
+                    suppress_until[target] = until
+        return False
+
+    def _schedule_note_off(self, base_note):
+        """Schedule automatic note off after the configured duration."""
+        scheduler = self._device.scheduler
+        if scheduler is None:
+            return
+        timer = self._off_timers.pop(base_note, None)
+        if timer is not None:
+            timer.cancel()
+        self._off_timers[base_note] = scheduler.call_later(
+                            self._duration, self._auto_note_off, base_note)
+
+    def _auto_note_off(self, base_note):
+        """Release notes started for `base_note`."""
+        self._off_timers.pop(base_note, None)
+        sounding = self._sounding.pop(base_note, None)
+        if not sounding:
+            return
+        sink = self._device.scheduler.sink
+        timestamp = time.time()
+        channel, notes = sounding
+        for note in notes:
+            if self._debug:
+                logger.debug("  auto note off: %r, %r", channel, note)
+            sink(midi.NoteOff(channel, note, 0, timestamp), self._device)
+
+    @property
+    def sounding(self):
+        """True if any notes started by this handler are still on."""
+        return bool(self._sounding)
+
+    def adopt(self, other):
+        """Take over the state of `other` handler of the same input.
+
+        Used when the handler replaces `other` in the event map, so the
+        notes started by `other` are released by this one.
+
+        Return note off messages for notes which cannot be taken over.
+        """
+        scheduler = self._device.scheduler
+        msgs = []
+        for base_note, sounding in other._sounding.items():
+            timer = other._off_timers.pop(base_note, None)
+            if timer is not None:
+                timer.cancel()
+            if self._note is not None:
+                # the input will be released as self._note now
+                base_note = self._note
+            if base_note in self._sounding:
+                channel, notes = sounding
+                msgs += [midi.NoteOff(channel, note, 0, time.time())
+                         for note in notes]
+                continue
+            self._sounding[base_note] = sounding
+            if timer is not None and scheduler is not None:
+                self._off_timers[base_note] = scheduler.call_at(
+                                            timer.when, self._auto_note_off,
+                                            base_note)
+        other._sounding.clear()
+        return msgs
+
+    def release(self):
+        """Return note off messages for all notes started by this handler."""
+        for timer in self._off_timers.values():
+            timer.cancel()
+        self._off_timers.clear()
+        timestamp = time.time()
+        msgs = [midi.NoteOff(channel, note, 0, timestamp)
+                for channel, notes in self._sounding.values()
+                for note in notes]
+        self._sounding.clear()
+        return msgs
 
 class BaseInputDevice(object):
     KEYMAP_DEFAULTS = {
@@ -101,30 +350,233 @@ class BaseInputDevice(object):
             "velocity": "127",
             }
     name = "unknown"
+    # Scheduler for delayed messages, set by the application
+    scheduler = None
+    # messages are delivered by `dispatch()` instead of async iteration
+    direct_dispatch = False
+    # the device reports key releases (needed by momentary layer switches)
+    release_events = True
     def __init__(self, config, section, main_loop):
         self.main_loop = main_loop
         self.config = config
         self.config_section = section
+        self.events_metric = metrics.counter("badumtss_input_events_total",
+                                             "Input events received",
+                                             device=self.name)
+        self._layer_switches_metric = metrics.counter(
+                                        "badumtss_layer_switches_total",
+                                        "Keymap layer switches",
+                                        device=self.name)
+        self.retrigger_metric = metrics.counter(
+                                        "badumtss_hits_suppressed_total",
+                                        "Hits dropped by retrigger or"
+                                        " crosstalk limits",
+                                        device=self.name, reason="retrigger")
+        self.crosstalk_metric = metrics.counter(
+                                        "badumtss_hits_suppressed_total",
+                                        "Hits dropped by retrigger or"
+                                        " crosstalk limits",
+                                        device=self.name, reason="crosstalk")
+        # hit filtering state, indexed by binding_slot()
+        self._binding_slots = {}
+        self.hit_times = array("d")
+        self.suppress_until = array("d")
+        self.suppress_velocity = array("d")
+        self._selected_layer = ""
+        self._momentary_layers = []
+        keymaps = self.read_keymap(config, section)
+        self.keymap_config = keymaps[""]
+        self._layers = self.load_layers(keymaps)
+        self._assign_slots(self._layers)
+        self._event_map = self._layers[""]
+
+    def read_keymap(self, config, section):
+        """Read keymap file configured in the `section` of `config`.
+
+        Keymap may define layers: `[INPUT@LAYER]` sections replace `[INPUT]`
+        binding in the LAYER, `[layer:LAYER]` section holds defaults for
+        all the bindings in the LAYER.
+
+        Return a dictionary of ConfigParser objects, one for each layer,
+        the base layer named "".
+        """
         keymap_file = config[section].get("keymap", None)
-        self.keymap_config = ConfigParser(interpolation=ExtendedInterpolation(),
-                                          default_section="defaults")
-        self.set_keymap_defaults()
+        raw_config = ConfigParser(interpolation=None,
+                                  default_section=_RAW_DEFAULT_SECTION)
         if keymap_file:
             keymap_file = os.path.expanduser(keymap_file)
-            if not self.keymap_config.read(keymap_file):
+            if not raw_config.read(keymap_file):
                 logger.warning("Could not load keymap: %r", keymap_file)
-        self.load_keymap()
+        layer_names = {""}
+        for raw_section in raw_config.sections():
+            if raw_section.startswith(LAYER_SECTION_PREFIX):
+                layer_names.add(raw_section[len(LAYER_SECTION_PREFIX):])
+            else:
+                layer_names.add(split_layer_section(raw_section)[1])
+        keymaps = {}
+        for layer in layer_names:
+            keymap_config = ConfigParser(
+                                    interpolation=ExtendedInterpolation(),
+                                    default_section="defaults")
+            self.set_keymap_defaults(keymap_config)
+            defaults = keymap_config["defaults"]
+            if raw_config.has_section("defaults"):
+                defaults.update(raw_config["defaults"])
+            if layer:
+                layer_section = LAYER_SECTION_PREFIX + layer
+                if raw_config.has_section(layer_section):
+                    defaults.update(raw_config[layer_section])
+            for raw_section in raw_config.sections():
+                if (raw_section == "defaults"
+                        or raw_section.startswith(LAYER_SECTION_PREFIX)):
+                    continue
+                name, section_layer = split_layer_section(raw_section)
+                if not section_layer:
+                    if not keymap_config.has_section(name):
+                        keymap_config[name] = raw_config[raw_section]
+                elif section_layer == layer:
+                    # replaces the base layer binding
+                    keymap_config[name] = raw_config[raw_section]
+            keymaps[layer] = keymap_config
+        return keymaps
+
+    def binding_slot(self, name):
+        """Return index of the binding `name` in the hit filtering state
+        arrays.
+
+        The same index is returned for the binding in all the layers and
+        after keymap reloads."""
+        try:
+            return self._binding_slots[name]
+        except KeyError:
+            pass
+        slot = len(self.hit_times)
+        self.hit_times.append(0.0)
+        self.suppress_until.append(0.0)
+        self.suppress_velocity.append(0.0)
+        self._binding_slots[name] = slot
+        return slot
+
+    def _assign_slots(self, layers):
+        """Assign hit filtering state slots to all the handlers of
+        `layers`."""
+        for event_map in layers.values():
+            for handler in event_map.values():
+                handler.assign_slots()
 
-    def set_keymap_defaults(self):
+    def set_keymap_defaults(self, keymap_config):
         """Set keymap defaults."""
-        self.keymap_config["defaults"].update(self.KEYMAP_DEFAULTS)
+        keymap_config["defaults"].update(self.KEYMAP_DEFAULTS)
 
-    def load_keymap(self):
-        """Process `self.keymap_config` ConfigParser object to build internal
-        input event to EventHandler object mapping.
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
         """
         raise NotImplementedError
 
+    def load_layers(self, keymaps):
+        """Build event maps for all keymap layers.
+
+        `keymaps` is a dictionary returned by `read_keymap()`.
+        Return a dictionary of layer name -> event map.
+        """
+        return {layer: self.load_keymap(keymap_config)
+                for layer, keymap_config in keymaps.items()}
+
+    def switch_layer(self, layer, mode, on):
+        """Process an event of a layer switching binding.
+
+        `mode` is one of: `momentary` (the layer is active while the
+        binding is held), `latch` (press switches to the layer and back
+        to the base layer) or `select` (press selects the layer).
+
+        Return note off messages for notes which cannot be released
+        after the switch.
+        """
+        if layer not in self._layers:
+            logger.warning("Unknown keymap layer: %r", layer)
+            return []
+        if mode == "momentary":
+            if on:
+                self._momentary_layers.append(layer)
+            elif layer in self._momentary_layers:
+                self._momentary_layers.remove(layer)
+        elif not on:
+            return []
+        elif mode == "latch" and self._selected_layer == layer:
+            self._selected_layer = ""
+        else:
+            self._selected_layer = layer
+        return self._activate_layer()
+
+    def _activate_layer(self):
+        """Switch to the event map of the current layer."""
+        if self._momentary_layers:
+            layer = self._momentary_layers[-1]
+        else:
+            layer = self._selected_layer
+        event_map = self._layers[layer]
+        if event_map is self._event_map:
+            return []
+        self._layer_switches_metric.inc()
+        logger.debug("%s: switching to layer %r", self.name, layer)
+        return self.set_event_map(event_map)
+
+    def prepare_reload(self, config):
+        """Read the keymap for new `config`.
+
+        Only parses the files and does not change the device state, so may
+        be called in a worker thread. Return data to be passed to
+        `apply_reload()`.
+        """
+        return config, self.read_keymap(config, self.config_section)
+
+    def apply_reload(self, prepared):
+        """Build event maps from keymap read by `prepare_reload()` and
+        switch to them.
+
+        The current layer is kept if it still exists.
+
+        Return note off messages for notes which cannot be released
+        by the new keymap.
+        """
+        config, keymaps = prepared
+        layers = self.load_layers(keymaps)
+        self._assign_slots(layers)
+        self.config = config
+        self.keymap_config = keymaps[""]
+        self._layers = layers
+        if self._selected_layer not in layers:
+            self._selected_layer = ""
+        self._momentary_layers = [layer for layer in self._momentary_layers
+                                  if layer in layers]
+        return self._activate_layer()
+
+    def set_event_map(self, event_map):
+        """Replace the event map.
+
+        The replacement is a single attribute assignment, so events are
+        handled either by the old or by the new map. Notes started via the
+        old map are passed to the new handlers of the same inputs.
+
+        Return note off messages for notes which cannot be released
+        by the new event map.
+        """
+        old_map = self._event_map
+        self._event_map = event_map
+        msgs = []
+        for key, old_handler in old_map.items():
+            if not old_handler.sounding:
+                continue
+            handler = event_map.get(key)
+            if handler is None:
+                msgs += old_handler.release()
+            elif handler is not old_handler:
+                msgs += handler.adopt(old_handler)
+        return msgs
+
     def start(self):
         """Prepare device for processing events."""
         pass
@@ -137,6 +589,14 @@ class BaseInputDevice(object):
         """Read single keypress from the device."""
         raise NotImplementedError
 
+    async def dispatch(self, route):
+        """Pass MIDI or control messages to `route(msg)` until the device is
+        stopped.
+
+        Used instead of iterating over the device in devices setting
+        `direct_dispatch`."""
+        raise NotImplementedError
+
     async def __aiter__(self):
         """Generate MIDI or controll messages."""
         raise NotImplementedError
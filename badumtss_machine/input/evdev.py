@@ -25,18 +25,90 @@
 
 import time
 import logging
+import os
 import re
 import math
 import asyncio
+import select
+import struct
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 import evdev
 from evdev.ecodes import EV_KEY, EV_ABS
 
 from .base import EventHandler, BaseInputDevice
+from .. import metrics
+from .. import midi
+from .. import watchdog
 
 logger = logging.getLogger("input.evdev")
 
+# maximum number of threads opening devices at once
+PROBE_THREADS = 8
+
+# devices found by probe_input_devices(), by config section
+_probed = {}
+
+# the EventMultiplexer in use
+_multiplexer = None
+
+# struct input_event: struct timeval, __u16 type, __u16 code, __s32 value
+INPUT_EVENT = struct.Struct("llHHi")
+
+# number of events read at once
+READ_EVENTS = 64
+
+# default peak detection scan window in milliseconds
+DEFAULT_SCAN_TIME = 10.0
+
+# number of axis samples kept for peak detection
+PEAK_RING_SIZE = 64
+
+# passed to AbsEventHandler.translate() when the peak scan time is over
+_SCAN_DONE = object()
+
+class RawEvent(object):
+    """Decoded `struct input_event`.
+
+    Provides the attributes of both python-evdev InputEvent and
+    the KeyEvent/AbsEvent wrappers used by the event handlers, so only
+    one object is created per event and only for the events mapped.
+    """
+    __slots__ = ("sec", "usec", "type", "code", "value")
+    key_up = 0
+    key_down = 1
+    key_hold = 2
+    def __init__(self, sec, usec, ev_type, code, value):
+        self.sec = sec
+        self.usec = usec
+        self.type = ev_type
+        self.code = code
+        self.value = value
+
+    @property
+    def event(self):
+        return self
+
+    @property
+    def keystate(self):
+        return self.value
+
+    def timestamp(self):
+        return self.sec + self.usec / 1000000.0
+
+def get_absinfo(device, key):
+    """Return absinfo for an axis of an EventDevice or None."""
+    absinfo = device.absinfo.get(key)
+    if absinfo is None:
+        logger.error("Cannot retrieve absinfo for %r", key[1])
+    return absinfo
+
 class KeyEventHandler(EventHandler):
+    def get_timestamp(self, event):
+        return event.event.timestamp()
+
     def interpret_event(self, event):
         if event.keystate == event.key_down:
             return "on"
@@ -46,6 +118,17 @@ class KeyEventHandler(EventHandler):
             return "ignore"
 
 class AbsEventHandler(EventHandler):
+    """Translate axis movement to notes.
+
+    With the default `trigger=threshold` the note starts when the value
+    rises above `thres_high`, with velocity computed from the speed of
+    the move. With `trigger=peak` the value crossing `thres_high` starts
+    a scan for the peak, which lasts until the value starts falling or
+    `scan_time` milliseconds pass, and the peak height (between
+    `thres_high` and the axis maximum) gives the velocity, which may be
+    shaped with `velocity_curve`. The note stops when the value falls
+    below `thres_low`.
+    """
     def __init__(self, device, key, settings):
         super().__init__(device, key, settings)
         self._last_value = None
@@ -56,13 +139,22 @@ class AbsEventHandler(EventHandler):
         self._thres_high = None
         self._velocity = None
         self._velocity_coeff = float(settings.get("velocity_coeff", 2.0))
-        etype, ecode  = key
-        abs_caps = device.device.capabilities(absinfo=True)[etype]
-        for code, absinfo in abs_caps:
-            if code == ecode:
-                break
-        else:
-            logger.error("Cannot retrieve absinfo for %r", ecode)
+        trigger = settings.get("trigger", "threshold")
+        if trigger not in ("threshold", "peak"):
+            logger.warning("[%s]: unknown trigger mode: %r", settings.name,
+                           trigger)
+        self._peak_mode = (trigger == "peak")
+        self._scan_time = float(settings.get("scan_time",
+                                             DEFAULT_SCAN_TIME)) / 1000.0
+        self._ring_values = array("l", [0]) * PEAK_RING_SIZE
+        self._ring_pos = 0
+        self._scan_count = 0
+        self._scan_ts = None
+        self._scan_timer = None
+        # note on messages of a scan finished by the note off event
+        self._scan_msgs = None
+        absinfo = get_absinfo(device, key)
+        if absinfo is None:
             return
         self._min = absinfo.min
         self._max = absinfo.max
@@ -81,6 +173,23 @@ class AbsEventHandler(EventHandler):
         else:
             self._thres_high = self._max
 
+    def get_timestamp(self, event):
+        if event is _SCAN_DONE:
+            return self._last_value_ts
+        return event.event.timestamp()
+
+    def adopt(self, other):
+        if isinstance(other, AbsEventHandler):
+            # keep tracking the axis movement
+            self._last_value = other._last_value
+            self._last_value_ts = other._last_value_ts
+            other._cancel_scan()
+        return super().adopt(other)
+
+    def release(self):
+        self._cancel_scan()
+        return super().release()
+
     def get_velocity(self):
         if self._velocity is not None:
             return self._velocity
@@ -101,7 +210,8 @@ class AbsEventHandler(EventHandler):
         else:
             time_change = event_ts - self._last_value_ts
             velocity = abs(rel_change / time_change)
-        logger.debug("unscaled velocity: %f", velocity)
+        if self._debug:
+            logger.debug("unscaled velocity: %f", velocity)
         if velocity != math.inf:
             velocity = int(velocity * self._velocity_coeff)
         if velocity < 0:
@@ -111,7 +221,117 @@ class AbsEventHandler(EventHandler):
         else:
             self._velocity = velocity
 
+    def _cancel_scan(self):
+        if self._scan_timer is not None:
+            self._scan_timer.cancel()
+            self._scan_timer = None
+        self._scan_ts = None
+
+    def _finish_scan(self):
+        """Compute velocity from the highest sample since the scan
+        started."""
+        if self._scan_timer is not None:
+            self._scan_timer.cancel()
+            self._scan_timer = None
+        ring = self._ring_values
+        count = min(self._scan_count, PEAK_RING_SIZE)
+        end = self._ring_pos
+        if count <= end:
+            peak = max(ring[end - count:end])
+        else:
+            peak = max(max(ring[:end], default=self._min),
+                       max(ring[end - count:]))
+        span = self._max - self._thres_high
+        if span > 0:
+            velocity = 1 + int((peak - self._thres_high) * 126 / span)
+            self._velocity = max(1, min(velocity, 127))
+        else:
+            self._velocity = 127
+        if self._debug:
+            logger.debug("peak: %r, velocity: %r", peak, self._velocity)
+
+    def _scan_result(self):
+        """Finish the scan and return the note on messages as a list."""
+        msgs = self.translate(_SCAN_DONE)
+        if msgs is None:
+            return []
+        if not isinstance(msgs, list):
+            return [msgs]
+        return msgs
+
+    def _scan_timeout(self):
+        """Emit the note when the scan time is over."""
+        self._scan_timer = None
+        if self._scan_ts is None:
+            return
+        msgs = self._scan_result()
+        if not msgs:
+            return
+        route = self._device.route
+        if route is not None:
+            # same path as the notes emitted on the falling edge
+            route(msgs)
+        else:
+            sink = self._device.scheduler.sink
+            for msg in msgs:
+                sink(msg, self._device)
+
+    def translate(self, event):
+        msgs = super().translate(event)
+        scan_msgs = self._scan_msgs
+        if scan_msgs is None:
+            return msgs
+        self._scan_msgs = None
+        if msgs is None:
+            msgs = []
+        elif not isinstance(msgs, list):
+            msgs = [msgs]
+        return scan_msgs + msgs or None
+
+    def _interpret_peak(self, event):
+        if event is _SCAN_DONE:
+            self._finish_scan()
+            self._scan_ts = None
+            return "on"
+        value = event.event.value
+        event_ts = event.event.timestamp()
+        last_value = self._last_value
+        self._last_value = value
+        self._last_value_ts = event_ts
+        pos = self._ring_pos
+        self._ring_values[pos] = value
+        self._ring_pos = (pos + 1) % PEAK_RING_SIZE
+        if last_value is None:
+            return "ignore"
+        if self._scan_ts is not None:
+            self._scan_count += 1
+            if (value >= last_value
+                    and event_ts - self._scan_ts < self._scan_time
+                    and self._scan_count < PEAK_RING_SIZE):
+                return "ignore"
+            # peak passed, scan time over or buffer full
+            if value >= self._thres_low:
+                self._finish_scan()
+                self._scan_ts = None
+                return "on"
+            # already released, send the note now (before the note off
+            # returned by translate()) and stop it
+            self._scan_msgs = self._scan_result()
+            return "off"
+        if value > self._thres_high and last_value <= self._thres_high:
+            self._scan_ts = event_ts
+            self._scan_count = 1
+            if self._device.scheduler is not None:
+                self._scan_timer = self._device.scheduler.call_later(
+                                        self._scan_time, self._scan_timeout)
+            return "ignore"
+        if value < self._thres_low and last_value >= self._thres_low:
+            return "off"
+        return "ignore"
+
     def interpret_event(self, event):
+        if self._peak_mode:
+            return self._interpret_peak(event)
         value = event.event.value
         event_ts = event.event.timestamp()
         if self._last_value is None:
@@ -136,19 +356,197 @@ class AbsEventHandler(EventHandler):
         self._last_value_ts = event_ts
         return result
 
+class AbsControllerHandler(EventHandler):
+    """Translate axis position to a continuous controller value.
+
+    The `control` keymap setting selects the message: controller number for
+    Control Change, `pitch_bend` or `channel_pressure`. `deadband` (absolute
+    or percent of the axis range) is the part of the range around the rest
+    position (the center for pitch bend, the minimum otherwise) reported
+    as no change, `threshold` the minimum change of the output value for
+    a new message to be sent.
+    """
+    def __init__(self, device, key, settings):
+        super().__init__(device, key, settings)
+        self._channel = int(settings["channel"])
+        self._threshold = int(settings.get("threshold", 1))
+        self._last_out = None
+        self._pitch_bend = False
+        self._message = None
+        control = settings["control"]
+        if control == "pitch_bend":
+            self._pitch_bend = True
+            self._message = midi.PitchBend
+        elif control == "channel_pressure":
+            self._message = midi.ChannelPressure
+        else:
+            controller = int(control)
+            self._message = (lambda channel, value, timestamp:
+                             midi.ControlChange(channel, controller, value,
+                                                timestamp))
+        absinfo = get_absinfo(device, key)
+        if absinfo is None:
+            self._message = None
+            return
+        if self._pitch_bend:
+            self._rest = (absinfo.min + absinfo.max) / 2.0
+            self._max_out = 8191
+            self._min_out = -8192
+            half_range = (absinfo.max - absinfo.min) / 2.0
+        else:
+            self._rest = absinfo.min
+            self._max_out = 127
+            self._min_out = 0
+            half_range = absinfo.max - absinfo.min
+        deadband = settings.get("deadband", "0")
+        if deadband.endswith("%"):
+            deadband = (float(deadband[:-1])
+                        * (absinfo.max - absinfo.min) / 100.0)
+        else:
+            deadband = float(deadband)
+        self._deadband = deadband
+        if half_range > deadband:
+            self._scale = (self._max_out + 1) / (half_range - deadband)
+        else:
+            self._scale = 0
+
+    def _value_to_output(self, value):
+        offset = value - self._rest
+        if offset >= 0:
+            offset -= self._deadband
+            if offset <= 0:
+                return 0
+            return min(int(offset * self._scale), self._max_out)
+        else:
+            offset += self._deadband
+            if offset >= 0:
+                return 0
+            return max(int(offset * self._scale), self._min_out)
+
+    def translate(self, event):
+        if self._message is None:
+            return None
+        out = self._value_to_output(event.event.value)
+        last_out = self._last_out
+        if last_out is not None:
+            if out == last_out:
+                return None
+            if (abs(out - last_out) < self._threshold
+                    and out not in (0, self._min_out, self._max_out)):
+                return None
+        self._last_out = out
+        return self._message(self._channel, out, event.event.timestamp())
+
+class EventMultiplexer(object):
+    """Read events from all the event devices.
+
+    Device file descriptors are registered in a single epoll set, which
+    is the only reader on the asyncio loop. On each wakeup every ready
+    device is drained and its messages are passed directly to the
+    device's route function, so the cost per wakeup does not depend on
+    the number of devices.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._epoll = select.epoll()
+        self._devices = {}
+        self._reading = False
+        self._wakeups_metric = metrics.counter(
+                                    "badumtss_evdev_wakeups_total",
+                                    "Event device multiplexer wakeups")
+
+    def add(self, device, route):
+        """Start reading events from `device`.
+
+        Return a future completed when the device is removed or lost."""
+        future = self.loop.create_future()
+        fd = device.device.fd
+        self._epoll.register(fd, select.EPOLLIN)
+        self._devices[fd] = (device, route, future)
+        future.add_done_callback(lambda f: self.remove(device))
+        if not self._reading:
+            self.loop.add_reader(self._epoll.fileno(), self._process)
+            self._reading = True
+        return future
+
+    def remove(self, device):
+        """Stop reading events from `device`."""
+        fd = device.device.fd
+        entry = self._devices.get(fd)
+        if entry is None or entry[0] is not device:
+            return
+        del self._devices[fd]
+        try:
+            self._epoll.unregister(fd)
+        except (OSError, ValueError):
+            # already closed
+            pass
+        if not entry[2].done():
+            entry[2].set_result(None)
+        if not self._devices and self._reading:
+            self.loop.remove_reader(self._epoll.fileno())
+            self._reading = False
+
+    def _process(self):
+        self._wakeups_metric.inc()
+        devices = self._devices
+        for fd, mask in self._epoll.poll(0):
+            entry = devices.get(fd)
+            if entry is None:
+                continue
+            device, route, future = entry
+            watchdog.busy_device = device
+            try:
+                device.read_events(route)
+            except OSError as err:
+                del devices[fd]
+                try:
+                    self._epoll.unregister(fd)
+                except (OSError, ValueError):
+                    pass
+                if not future.done():
+                    future.set_exception(err)
+            finally:
+                watchdog.busy_device = None
+        if not devices and self._reading:
+            self.loop.remove_reader(self._epoll.fileno())
+            self._reading = False
+
+def get_multiplexer(loop):
+    """Return the EventMultiplexer for `loop`."""
+    global _multiplexer
+    if _multiplexer is None or _multiplexer.loop is not loop:
+        _multiplexer = EventMultiplexer(loop)
+    return _multiplexer
+
 class EventDevice(BaseInputDevice):
-    def __init__(self, config, section, main_loop, device):
+    direct_dispatch = True
+    def __init__(self, config, section, main_loop, device, capabilities=None):
         self._done = False
+        # set by dispatch(), used for messages emitted by handler timers
+        self.route = None
         self.device = device
         self.name = "{} ({})".format(device.name, device.fn)
+        self._buffer = bytearray(INPUT_EVENT.size * READ_EVENTS)
+        self._view = memoryview(self._buffer)
+        if capabilities is None:
+            capabilities = device.capabilities(absinfo=True)
+        self.capabilities = capabilities
+        # queried once, shared by all the axis handlers
+        self.absinfo = {(ev_type, item[0]): item[1]
+                        for ev_type, items in capabilities.items()
+                        for item in items if isinstance(item, tuple)}
         self._event_map = {}
         BaseInputDevice.__init__(self, config, section, main_loop)
 
-    def load_keymap(self):
-        """Process `self.keymap_config` ConfigParser object to build internal
-        input event to EventHandler object mapping.
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
         """
-        for section in self.keymap_config:
+        event_map = {}
+        for section in keymap_config:
             if section.startswith("KEY_") or section.startswith("BTN_"):
                 try:
                     ecode = evdev.ecodes.ecodes[section]
@@ -163,75 +561,183 @@ class EventDevice(BaseInputDevice):
                 except KeyError:
                     logger.warning("Unknown axis name: %r", section)
                     continue
-                handler_class = AbsEventHandler
+                if "control" in keymap_config[section]:
+                    handler_class = AbsControllerHandler
+                else:
+                    handler_class = AbsEventHandler
                 ev_type = EV_ABS
             else:
                 continue
             key = (ev_type, ecode)
-            settings = self.keymap_config[section]
+            settings = keymap_config[section]
             handler = handler_class(self, key, settings)
-            self._event_map[key] = handler
+            event_map[key] = handler
+        return event_map
 
     def stop(self):
         """Stop processing events."""
         self._done = True
+        get_multiplexer(self.main_loop).remove(self)
         self.device.close()
 
-    async def __aiter__(self):
-        return self
+    async def dispatch(self, route):
+        """Pass messages to `route(msg)` until the device is stopped.
 
-    async def __anext__(self):
-        async for event in self.device.async_read_loop():
-            if self._done:
-                raise StopAsyncIteration
-            ev_type = event.type
-            ev_code = event.code
-            event = evdev.categorize(event)
-            handler = self._event_map.get((ev_type, ev_code))
-            if handler:
-                msg = handler.translate(event)
-                if msg is not None:
-                    return msg
-    async def get_key(self):
-        """Read single keypress from the device."""
-        key_name = None
+        Events are read by the EventMultiplexer."""
+        if self._done:
+            return
+        self.route = route
+        await get_multiplexer(self.main_loop).add(self, route)
+
+    def read_events(self, route):
+        """Read all pending events, pass resulting messages to `route`.
+
+        Events are read in blocks into a reusable buffer and decoded with
+        struct, objects are created only for the events mapped."""
+        fd = self.device.fd
+        buffers = [self._buffer]
+        view = self._view
+        iter_unpack = INPUT_EVENT.iter_unpack
+        event_size = INPUT_EVENT.size
+        events_metric = self.events_metric
+        while True:
+            try:
+                size = os.readv(fd, buffers)
+            except BlockingIOError:
+                return
+            if not size:
+                raise OSError("End of file")
+            size -= size % event_size
+            events_metric.inc(size // event_size)
+            for sec, usec, ev_type, code, value in iter_unpack(view[:size]):
+                # looked up for every event, a handler may switch layers
+                handler = self._event_map.get((ev_type, code))
+                if handler is not None:
+                    msg = handler.translate(RawEvent(sec, usec, ev_type, code,
+                                                     value))
+                    if msg is not None:
+                        route(msg)
+            if size < len(self._buffer):
+                return
+
+    def _flush_events(self):
+        """Drop queued events."""
         try:
-            # flush queued events
-            self.device.read()
+            while True:
+                if not list(self.device.read()):
+                    break
         except BlockingIOError:
             pass
+
+    async def get_key(self):
+        """Read single keypress from the device.
+
+        An axis is reported when it moves by more than half of its range.
+        """
+        key_name = None
+        self._flush_events()
+        start_values = {}
         async for event in self.device.async_read_loop():
             ev_type = event.type
             ev_code = event.code
-            key_name = evdev.ecodes.bytype[ev_type].get(ev_code, str(ev_code))
             if ev_type == EV_KEY:
-                key_event = evdev.events.KeyEvent(event)
-                if key_event.keystate != key_event.key_down:
+                if event.value != RawEvent.key_down:
+                    continue
+            elif ev_type == EV_ABS:
+                absinfo = self.absinfo.get((ev_type, ev_code))
+                if absinfo is None:
+                    continue
+                start = start_values.setdefault(ev_code, event.value)
+                if abs(event.value - start) * 2 <= absinfo.max - absinfo.min:
                     continue
             else:
-                # FIXME: EV_ABS
                 continue
+            key_name = evdev.ecodes.bytype[ev_type].get(ev_code, str(ev_code))
             break
         if isinstance(key_name, list):
             key_name = key_name[0]
         return key_name
 
-def input_device_factory(config, section, main_loop):
+    def get_axis_range(self, key_name):
+        """Return (min, max) of the axis named `key_name` or None."""
+        ecode = evdev.ecodes.ecodes.get(key_name)
+        absinfo = self.absinfo.get((EV_ABS, ecode))
+        if absinfo is None:
+            return None
+        return absinfo.min, absinfo.max
+
+    async def record_axis(self, key_name, duration):
+        """Record values of the axis named `key_name` for `duration` seconds.
+
+        Return list of (timestamp, value) tuples."""
+        ecode = evdev.ecodes.ecodes.get(key_name)
+        samples = []
+        async def record():
+            async for event in self.device.async_read_loop():
+                if event.type == EV_ABS and event.code == ecode:
+                    samples.append((event.timestamp(), event.value))
+        self._flush_events()
+        try:
+            await asyncio.wait_for(record(), duration)
+        except asyncio.TimeoutError:
+            pass
+        return samples
+
+def _open_device(path, name_re):
+    """Open an event device if its name matches `name_re` and query its
+    capabilities.
+
+    Return (device, capabilities) tuple or None."""
+    try:
+        device = evdev.InputDevice(path)
+    except OSError as err:
+        logger.debug("Cannot open %r: %s", path, err)
+        return None
     try:
-        name = config[section]["name"]
-    except KeyError:
-        name = ".*"
-    input_device_re = re.compile(name)
-    devices = [evdev.InputDevice(fn) for fn in evdev.list_devices()]
-    devices = [dev for dev in devices if input_device_re.match(dev.name)]
+        if not name_re.match(device.name):
+            device.close()
+            return None
+        return device, device.capabilities(absinfo=True)
+    except OSError as err:
+        logger.debug("Cannot query %r: %s", path, err)
+        device.close()
+        return None
+
+def probe_devices(config, section):
+    """Open event devices matching the config section, concurrently.
+
+    Return list of (device, capabilities) tuples."""
+    name = config[section].get("name", ".*")
+    name_re = re.compile(name)
+    paths = evdev.list_devices()
+    if not paths:
+        return []
+    with ThreadPoolExecutor(min(PROBE_THREADS, len(paths))) as executor:
+        results = list(executor.map(lambda path: _open_device(path, name_re),
+                                    paths))
+    return [result for result in results if result is not None]
+
+def probe_input_devices(config, section):
+    """Find devices for a following `input_device_factory` call.
+
+    May be called in a worker thread."""
+    _probed[section] = probe_devices(config, section)
+
+def input_device_factory(config, section, main_loop):
+    devices = _probed.pop(section, None)
+    if devices is None:
+        devices = probe_devices(config, section)
     if not devices:
-        logger.debug("[%s]: no device matches name %r", section, name)
+        logger.debug("[%s]: no device matches name %r", section,
+                     config[section].get("name", ".*"))
         return
-    for device in devices:
+    for device, capabilities in devices:
         try:
-            handler = EventDevice(config, section, main_loop, device)
+            handler = EventDevice(config, section, main_loop, device,
+                                  capabilities)
         except Exception as err:
             logger.warning("[%s]: cannot load event device: %s", section, err)
             logger.debug("Exception:", exc_info=True)
+            device.close()
             continue
         yield handler
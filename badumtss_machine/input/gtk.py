@@ -24,7 +24,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import asyncio
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 import logging
 import signal
 
@@ -39,6 +39,7 @@ except (AttributeError, ValueError) as err:
 from gi.repository import Gtk, Gdk, GLib
 import cairo
 
+from .. import metrics
 from .base import EventHandler, BaseInputDevice
 from .. import control
 
@@ -65,6 +66,26 @@ KEY_WIDTH = 32
 WHITE_KEY_LENGTH = 100
 KEY_RATIO = 0.6
 BLACK_KEY_LENGTH = KEY_RATIO * WHITE_KEY_LENGTH
+WHITE_KEYS = 75
+
+def _build_note_table():
+    """Precompute note for every pixel column of the keyboard canvas.
+
+    Returns two `bytes` objects, one for the black key row (upper) and one
+    for the white key row (lower) of the keyboard.
+    """
+    table = []
+    for row in PIANOKEYS:
+        notes = bytearray()
+        for x in range(KEY_WIDTH * WHITE_KEYS):
+            pos = x * 4 // KEY_WIDTH
+            octave = x // (KEY_WIDTH * 7)
+            notes.append(12 * octave + row[pos % PIANOKEYS_LEN])
+        table.append(bytes(notes))
+    return table
+
+NOTE_TABLE = _build_note_table()
+NOTE_TABLE_WIDTH = len(NOTE_TABLE[0])
 
 CH_BUTTON_SIZE = 16
 
@@ -100,11 +121,16 @@ class GtkInputWindow(BaseInputDevice):
         self._queue = asyncio.Queue()
         self._gtk_event_handlers = {}
         self._keys_pressed = set()
-        self._buttons_pressed = set()
-        self._notes_pressed = defaultdict(set)
+        self._button_notes = {}
+        self._pending_motion = None
+        self._motion_tick_id = None
         self._scroll_set = False
         self._kb_canvas = None
+        self._debug = logger.isEnabledFor(logging.DEBUG)
         BaseInputDevice.__init__(self, config, section, main_loop)
+        metrics.gauge("badumtss_input_queue_depth",
+                      "Input events waiting for processing",
+                      func=lambda: self._queue.qsize(), device=self.name)
         self._create_window(window_name)
         self._window.show_all()
         GtkInputWindow._windows_opened += 1
@@ -138,7 +164,8 @@ class GtkInputWindow(BaseInputDevice):
             context.add_provider(style_provider, Gtk.STYLE_PROVIDER_PRIORITY_USER)
             top_box.add(button)
         self._kb_canvas = Gtk.DrawingArea()
-        self._kb_canvas.set_size_request(KEY_WIDTH * 75, WHITE_KEY_LENGTH)
+        self._kb_canvas.set_size_request(KEY_WIDTH * WHITE_KEYS,
+                                         WHITE_KEY_LENGTH)
         box.add(top_box)
         box.add(swindow)
         swindow.add(viewport)
@@ -147,7 +174,7 @@ class GtkInputWindow(BaseInputDevice):
         size = self._window.get_size()
         hints = Gdk.Geometry()
         hints.min_width = size.width
-        hints.max_width = size.width - KEY_WIDTH * 14 + KEY_WIDTH * 75
+        hints.max_width = size.width - KEY_WIDTH * 14 + KEY_WIDTH * WHITE_KEYS
         hints.min_height = size.height
         hints.max_height = size.height
         self._window.set_geometry_hints(self._window,
@@ -160,7 +187,8 @@ class GtkInputWindow(BaseInputDevice):
         self._kb_canvas.add_events(Gdk.EventMask.BUTTON_PRESS_MASK
                                    | Gdk.EventMask.BUTTON_RELEASE_MASK
                                    | Gdk.EventMask.LEAVE_NOTIFY_MASK
-                                   | Gdk.EventMask.POINTER_MOTION_MASK)
+                                   | Gdk.EventMask.POINTER_MOTION_MASK
+                                   | Gdk.EventMask.POINTER_MOTION_HINT_MASK)
 
     def _configure_scrolling(self, vadj):
         if not self._scroll_set:
@@ -203,19 +231,22 @@ class GtkInputWindow(BaseInputDevice):
 
         return False
 
-    def load_keymap(self):
-        """Process `self.keymap_config` ConfigParser object to build internal
-        input event to EventHandler object mapping.
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
         """
-        if "MOUSE" not in self.keymap_config:
-            self.keymap_config.add_section("MOUSE")
-        for section in self.keymap_config:
+        event_map = {}
+        if "MOUSE" not in keymap_config:
+            keymap_config.add_section("MOUSE")
+        for section in keymap_config:
             if section == "MOUSE":
                 handler_class = MouseClickEventHandler
                 ev_type = MouseClickEvent
                 keyval = None
-                if "note" not in self.keymap_config[section]:
-                    self.keymap_config[section]["note"] = "varies"
+                if "note" not in keymap_config[section]:
+                    keymap_config[section]["note"] = "varies"
             else:
                 handler_class = KeyEventHandler
                 ev_type = KeyEvent
@@ -223,9 +254,10 @@ class GtkInputWindow(BaseInputDevice):
                 if keyval == Gdk.KEY_VoidSymbol:
                     continue
             key = (ev_type, keyval)
-            settings = self.keymap_config[section]
+            settings = keymap_config[section]
             handler = handler_class(self, key, settings)
-            self._event_map[key] = handler
+            event_map[key] = handler
+        return event_map
 
     def start(self):
         """Prepare device for processing events."""
@@ -261,6 +293,10 @@ class GtkInputWindow(BaseInputDevice):
             h_id = self._gtk_event_handlers.pop(event, None)
             if h_id is not None:
                 self._kb_canvas.disconnect(h_id)
+        if self._motion_tick_id is not None:
+            self._kb_canvas.remove_tick_callback(self._motion_tick_id)
+            self._motion_tick_id = None
+        self._pending_motion = None
         self._done = True
         self._queue.put_nowait(None)
         self._queue = asyncio.Queue() # clear queue
@@ -271,48 +307,69 @@ class GtkInputWindow(BaseInputDevice):
             GtkInputWindow._windows_opened -= 1
         self._window = None
 
-    def _pointer_to_note(self, gdk_event):
-        pos = int(gdk_event.x * 4 / KEY_WIDTH)
-        row = int(gdk_event.y > BLACK_KEY_LENGTH)
-        octave = int(gdk_event.x / (KEY_WIDTH * 7))
-        return 12 * octave + PIANOKEYS[row][pos % PIANOKEYS_LEN]
+    def _pointer_to_note(self, x, y):
+        x = int(x)
+        if x < 0:
+            x = 0
+        elif x >= NOTE_TABLE_WIDTH:
+            x = NOTE_TABLE_WIDTH - 1
+        return NOTE_TABLE[y > BLACK_KEY_LENGTH][x]
 
     def _button_press_event_handler(self, canvas, gdk_event):
-        self._buttons_pressed.add(gdk_event.button)
-        note = self._pointer_to_note(gdk_event)
-        if note not in self._notes_pressed[gdk_event.button]:
-            self._notes_pressed[gdk_event.button].add(note)
+        self._flush_motion()
+        note = self._pointer_to_note(gdk_event.x, gdk_event.y)
+        if self._button_notes.get(gdk_event.button) != note:
+            self._button_notes[gdk_event.button] = note
             event = MouseClickEvent(key=note, on=True)
             self._queue.put_nowait(event)
 
     def _button_release_event_handler(self, canvas, gdk_event):
-        self._buttons_pressed.discard(gdk_event.button)
-        notes = set(self._notes_pressed[gdk_event.button])
-        self._notes_pressed[gdk_event.button].clear()
-        for note in notes:
+        self._flush_motion()
+        note = self._button_notes.pop(gdk_event.button, None)
+        if note is not None:
             event = MouseClickEvent(key=note, on=False)
             self._queue.put_nowait(event)
 
     def _motion_notify_event_handler(self, canvas, gdk_event):
-        note = self._pointer_to_note(gdk_event)
-        for button in self._buttons_pressed:
-            for act_note in list(self._notes_pressed[button]):
-                if act_note != note:
-                    self._notes_pressed[button].clear()
-                    event = MouseClickEvent(key=act_note, on=False)
-                    self._queue.put_nowait(event)
-            if note not in self._notes_pressed[button]:
-                self._notes_pressed[button].add(note)
-                event = MouseClickEvent(key=note, on=True)
-                self._queue.put_nowait(event)
+        """Remember the pointer position, to be processed on the next frame.
 
-    def _leave_notify_event_handler(self, canvas, gdk_event):
-        self._buttons_pressed.clear()
-        sets = self._notes_pressed.values()
-        if not sets:
+        Only the latest position in each frame matters, so any number of
+        motion events between frames costs a single note lookup.
+        """
+        if self._button_notes:
+            self._pending_motion = (gdk_event.x, gdk_event.y)
+            if self._motion_tick_id is None:
+                self._motion_tick_id = canvas.add_tick_callback(
+                                                        self._motion_tick)
+        # we use motion hints, ask for more events
+        Gdk.event_request_motions(gdk_event)
+
+    def _motion_tick(self, canvas, frame_clock):
+        self._motion_tick_id = None
+        self._flush_motion()
+        return GLib.SOURCE_REMOVE
+
+    def _flush_motion(self):
+        """Process pending pointer motion."""
+        if self._motion_tick_id is not None:
+            self._kb_canvas.remove_tick_callback(self._motion_tick_id)
+            self._motion_tick_id = None
+        if self._pending_motion is None:
             return
-        notes = set.union(*sets)
-        self._notes_pressed.clear()
+        x, y = self._pending_motion
+        self._pending_motion = None
+        note = self._pointer_to_note(x, y)
+        for button, act_note in self._button_notes.items():
+            if act_note == note:
+                continue
+            self._queue.put_nowait(MouseClickEvent(key=act_note, on=False))
+            self._queue.put_nowait(MouseClickEvent(key=note, on=True))
+            self._button_notes[button] = note
+
+    def _leave_notify_event_handler(self, canvas, gdk_event):
+        self._flush_motion()
+        notes = set(self._button_notes.values())
+        self._button_notes.clear()
         for note in notes:
             event = MouseClickEvent(key=note, on=False)
             self._queue.put_nowait(event)
@@ -346,7 +403,9 @@ class GtkInputWindow(BaseInputDevice):
                 raise StopAsyncIteration
             if event is None:
                 continue
-            logger.debug("event: %r", event)
+            self.events_metric.inc()
+            if self._debug:
+                logger.debug("event: %r", event)
             if isinstance(event, MouseClickEvent):
                 key = (MouseClickEvent, None)
             else:
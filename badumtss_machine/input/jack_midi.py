@@ -0,0 +1,301 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Receive notes from a Jack MIDI input port."""
+
+import asyncio
+import logging
+import os
+import re
+import time
+
+from array import array
+from collections import namedtuple
+
+import jack
+
+from .. import metrics
+from .base import EventHandler, BaseInputDevice, InputDeviceLoadError
+
+logger = logging.getLogger("input.jack_midi")
+
+CLIENT_NAME = "Badum-tss machine input"
+
+# records passed from the process callback (must be a power of two)
+RING_SIZE = 1024
+RING_MASK = RING_SIZE - 1
+
+JackMidiEvent = namedtuple("JackMidiEvent", "key on velocity timestamp")
+
+class JackMidiEventHandler(EventHandler):
+    def interpret_event(self, event):
+        self._event = event
+        if event.on:
+            return "on"
+        else:
+            return "off"
+
+    def get_velocity(self):
+        velocity = self._settings["velocity"]
+        if velocity == "remote":
+            return self._event.velocity
+        return int(velocity)
+
+    def get_timestamp(self, event):
+        return event.timestamp
+
+class JackMidiInputDevice(BaseInputDevice):
+    """Jack MIDI input port.
+
+    Notes are mapped with `NOTE_<number>` keymap sections. Only notes on
+    the binding's `input_channel` (by default: its `channel`) match.
+
+    The process callback only decodes note on/off events in place (through
+    a memoryview on the port buffer) and stores each as a single integer
+    (frame time, status and data bytes) in a preallocated ring buffer. The
+    ring has a single writer (the Jack thread) and a single reader (the
+    event loop), so it needs no locks. The loop is woken up through a pipe,
+    at most once per batch of records.
+    """
+    KEYMAP_DEFAULTS = {
+            "channel": "1",
+            "velocity": "remote",
+            }
+    def __init__(self, config, section, main_loop):
+        self.name = "Jack MIDI ({})".format(section)
+        self._done = False
+        self._active = False
+        self._queue = asyncio.Queue()
+        self._ring = array("Q", [0] * RING_SIZE)
+        self._write_index = 0
+        self._read_index = 0
+        self._overruns = 0
+        self._wakeup_pending = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._client = None
+        try:
+            self._init(config, section, main_loop)
+        except Exception:
+            if self._client is not None:
+                self._client.close()
+            self._close_pipe()
+            raise
+
+    def _init(self, config, section, main_loop):
+        """Initialize the device, after the wakeup pipe is created."""
+        source_ports_re = config[section].get("connect", ".*")
+        if source_ports_re:
+            self._source_ports_re = re.compile(source_ports_re)
+        else:
+            self._source_ports_re = None
+        BaseInputDevice.__init__(self, config, section, main_loop)
+        try:
+            self._client = jack.Client(CLIENT_NAME, no_start_server=True)
+        except jack.JackError as err:
+            raise InputDeviceLoadError("[{}]: could not connect to Jack: {}"
+                                       .format(section, err))
+        self._port = self._client.midi_inports.register("midi_in")
+        self._client.set_process_callback(self._process)
+        self._client.set_port_registration_callback(self._port_registration)
+        metrics.gauge("badumtss_input_queue_depth",
+                      "Input events waiting for processing",
+                      func=lambda: self._queue.qsize(), device=self.name)
+        metrics.counter("badumtss_jack_input_overruns_total",
+                        "Jack MIDI events dropped on full ring buffer",
+                        func=lambda: self._overruns, device=self.name)
+
+    def _close_pipe(self):
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
+        """
+        event_map = {}
+        for section in keymap_config:
+            if not section.startswith("NOTE_"):
+                continue
+            try:
+                number = int(section.split("_", 1)[1])
+            except ValueError:
+                logger.warning("Invalid input name: %r", section)
+                continue
+            settings = keymap_config[section]
+            try:
+                channel = int(settings.get("input_channel",
+                                           settings.get("channel", 1)))
+            except ValueError:
+                logger.warning("[%s]: invalid channel", section)
+                continue
+            key = ("NOTE", channel, number)
+            event_map[key] = JackMidiEventHandler(self, key, settings)
+        return event_map
+
+    def start(self):
+        """Activate the Jack client and start receiving events."""
+        if self._active:
+            return
+        self._active = True
+        self.main_loop.add_reader(self._wakeup_r, self._drain)
+        self._client.activate()
+        self._connect_ports()
+
+    def stop(self):
+        """Stop processing events."""
+        if self._done:
+            return
+        self._done = True
+        self._queue.put_nowait(None)
+        if self._active:
+            self.main_loop.remove_reader(self._wakeup_r)
+            self._client.deactivate()
+            self._active = False
+        self._client.close()
+        self._close_pipe()
+        if self._overruns:
+            logger.warning("%i Jack MIDI events dropped", self._overruns)
+
+    def _is_source_port(self, port):
+        if not self._source_ports_re:
+            return False
+        if port.name.startswith("Badum-tss machine"):
+            # our own ports
+            return False
+        return bool(self._source_ports_re.match(port.name))
+
+    def _connect_ports(self):
+        """Connect from available MIDI ports matching configured pattern."""
+        for port in self._client.get_ports(is_midi=True, is_output=True):
+            if self._is_source_port(port):
+                logger.info("Connecting from %r", port.name)
+                self._port.connect(port)
+
+    def _port_registration(self, port, register):
+        """Handle Jack port registration notification."""
+        if not register or not port.is_midi or not port.is_output:
+            return
+        if self._is_source_port(port):
+            logger.info("Connecting from %r", port.name)
+            self.main_loop.call_soon_threadsafe(self._port.connect, port)
+
+    def _process(self, frames):
+        """Pass note events from the port buffer to the ring."""
+        ring = self._ring
+        write_index = self._write_index
+        limit = self._read_index + RING_SIZE
+        base_frame = self._client.last_frame_time
+        for offset, data in self._port.incoming_midi_events():
+            if len(data) != 3:
+                continue
+            view = memoryview(data)
+            status = view[0]
+            if (status & 0xe0) != 0x80:
+                # not note on or off
+                continue
+            if write_index == limit:
+                self._overruns += 1
+                continue
+            ring[write_index & RING_MASK] = (
+                    ((base_frame + offset) & 0xffffffff) << 24
+                    | status << 16 | view[1] << 8 | view[2])
+            write_index += 1
+        if write_index != self._write_index:
+            self._write_index = write_index
+            if not self._wakeup_pending:
+                self._wakeup_pending = True
+                try:
+                    os.write(self._wakeup_w, b"\0")
+                except BlockingIOError:
+                    pass
+
+    def _drain(self):
+        """Move records from the ring to the event queue."""
+        try:
+            os.read(self._wakeup_r, 64)
+        except BlockingIOError:
+            pass
+        # cleared before reading the ring, so no record is left behind
+        self._wakeup_pending = False
+        read_index = self._read_index
+        write_index = self._write_index
+        if read_index == write_index:
+            return
+        ring = self._ring
+        put_nowait = self._queue.put_nowait
+        # Jack frame clock -> time.time() domain
+        now = time.time()
+        now_frame = self._client.frame_time
+        samplerate = self._client.samplerate
+        while read_index != write_index:
+            record = ring[read_index & RING_MASK]
+            read_index += 1
+            frame = record >> 24
+            velocity = record & 0x7f
+            on = ((record >> 20) & 0x0f) == 0x09 and velocity > 0
+            age = (now_frame - frame) & 0xffffffff
+            if age & 0x80000000:
+                # frame in the current period
+                age -= 0x100000000
+            timestamp = now - age / samplerate
+            put_nowait(JackMidiEvent(("NOTE", ((record >> 16) & 0x0f) + 1,
+                                      (record >> 8) & 0x7f),
+                                     on, velocity, timestamp))
+        self._read_index = read_index
+
+    async def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            event = await self._queue.get()
+            if self._done:
+                raise StopAsyncIteration
+            if event is None:
+                continue
+            self.events_metric.inc()
+            handler = self._event_map.get(event.key)
+            if handler:
+                msg = handler.translate(event)
+                if msg is not None:
+                    return msg
+
+    async def get_key(self):
+        """Read single note from the port."""
+        self.start()
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return None
+            if event.on:
+                return "NOTE_{}".format(event.key[2])
+
+def input_device_factory(config, section, main_loop):
+    yield JackMidiInputDevice(config, section, main_loop)
@@ -0,0 +1,295 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Receive triggers and notes from remote nodes over the network."""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from collections import namedtuple
+
+from .. import metrics
+from .base import EventHandler, BaseInputDevice, InputDeviceLoadError
+from .. import netproto
+
+logger = logging.getLogger("input.net")
+
+# max datagrams processed in a single reader callback
+RECV_BATCH = 64
+
+# how fast the clock offset estimate follows increasing delays
+OFFSET_ADJUST_RATE = 0.01
+
+NetEvent = namedtuple("NetEvent", "key on velocity timestamp")
+
+class SenderState(object):
+    """Packet sequence and clock offset tracking for a single sender."""
+    __slots__ = ("next_seq", "packets", "lost", "late", "offset")
+    def __init__(self, seq, offset):
+        self.next_seq = seq
+        self.packets = 0
+        self.lost = 0
+        self.late = 0
+        self.offset = offset
+
+    def update(self, seq, offset_sample):
+        """Check packet sequence number and update the clock offset
+        estimate.
+
+        The offset (local receive time minus remote send time) includes
+        network delay, so the lowest values are the most accurate: the
+        estimate follows lower samples immediately and higher ones (clock
+        drift) slowly.
+        """
+        self.packets += 1
+        diff = (seq - self.next_seq) & 0xffffffff
+        if diff < 0x80000000:
+            self.lost += diff
+            self.next_seq = (seq + 1) & 0xffffffff
+        else:
+            self.late += 1
+            if self.lost:
+                self.lost -= 1
+        if offset_sample < self.offset:
+            self.offset = offset_sample
+        else:
+            self.offset += (offset_sample - self.offset) * OFFSET_ADJUST_RATE
+
+class NetEventHandler(EventHandler):
+    def interpret_event(self, event):
+        self._event = event
+        if event.on:
+            return "on"
+        else:
+            return "off"
+
+    def get_velocity(self):
+        velocity = self._settings["velocity"]
+        if velocity == "remote":
+            return self._event.velocity
+        return int(velocity)
+
+    def get_timestamp(self, event):
+        return event.timestamp
+
+class NetInputDevice(BaseInputDevice):
+    """Network input.
+
+    Receives trigger and MIDI packets (see the `netproto` module) from any
+    number of senders. Triggers are mapped with `TRIGGER_<number>` keymap
+    sections, MIDI notes with `NOTE_<number>` sections.
+    """
+    KEYMAP_DEFAULTS = {
+            "channel": "1",
+            "velocity": "remote",
+            }
+    def __init__(self, config, section, main_loop):
+        self.name = "Network ({})".format(section)
+        self._done = False
+        self._event_map = {}
+        self._queue = asyncio.Queue()
+        self._senders = {}
+        self._buffer = bytearray(netproto.MAX_PACKET_SIZE)
+        self._view = memoryview(self._buffer)
+        self._socket = None
+        self._unix_path = None
+        try:
+            family, address = netproto.parse_address(
+                                        config[section].get("listen", ""))
+        except ValueError as err:
+            raise InputDeviceLoadError("[{}]: {}".format(section, err))
+        BaseInputDevice.__init__(self, config, section, main_loop)
+        metrics.gauge("badumtss_input_queue_depth",
+                      "Input events waiting for processing",
+                      func=lambda: self._queue.qsize(), device=self.name)
+        self._open_socket(family, address)
+
+    def _open_socket(self, family, address):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            if family == socket.AF_UNIX:
+                if os.path.exists(address):
+                    os.unlink(address)
+                self._unix_path = address
+            sock.bind(address)
+        except OSError as err:
+            sock.close()
+            raise InputDeviceLoadError("[{}]: cannot listen on {!r}: {}"
+                                       .format(self.config_section,
+                                               address, err))
+        sock.setblocking(False)
+        self._socket = sock
+
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
+        """
+        event_map = {}
+        for section in keymap_config:
+            if section.startswith("TRIGGER_"):
+                ev_type = "TRIGGER"
+            elif section.startswith("NOTE_"):
+                ev_type = "NOTE"
+            else:
+                continue
+            try:
+                number = int(section.split("_", 1)[1])
+            except ValueError:
+                logger.warning("Invalid input name: %r", section)
+                continue
+            key = (ev_type, number)
+            settings = keymap_config[section]
+            event_map[key] = NetEventHandler(self, key, settings)
+        return event_map
+
+    def start(self):
+        """Start receiving packets."""
+        self._done = False
+        self.main_loop.add_reader(self._socket.fileno(), self._reader)
+
+    def stop(self):
+        """Stop processing events."""
+        if self._done or not self._socket:
+            return
+        self._done = True
+        self._queue.put_nowait(None)
+        self.main_loop.remove_reader(self._socket.fileno())
+        for addr, sender in self._senders.items():
+            logger.info("Sender %r: %i packets, %i lost, %i late",
+                        addr, sender.packets, sender.lost, sender.late)
+        self._socket.close()
+        self._socket = None
+        if self._unix_path:
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+
+    def _reader(self):
+        """Receive all pending datagrams (up to RECV_BATCH)."""
+        recvfrom_into = self._socket.recvfrom_into
+        for i in range(RECV_BATCH):
+            try:
+                nbytes, addr = recvfrom_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                logger.warning("Receive error: %s", err)
+                break
+            try:
+                self._process_packet(self._view[:nbytes], addr, time.time())
+            except netproto.PacketError as err:
+                logger.debug("Invalid packet from %r: %s", addr, err)
+
+    def _register_sender_metrics(self, addr, sender):
+        labels = {"device": self.name, "sender": str(addr)}
+        metrics.counter("badumtss_net_packets_total",
+                        "Packets received from a remote node",
+                        func=lambda: sender.packets, **labels)
+        metrics.counter("badumtss_net_packets_lost_total",
+                        "Packets from a remote node lost",
+                        func=lambda: sender.lost, **labels)
+        metrics.counter("badumtss_net_packets_late_total",
+                        "Packets from a remote node received out of order",
+                        func=lambda: sender.late, **labels)
+        metrics.gauge("badumtss_net_clock_offset_seconds",
+                      "Estimated remote node clock offset",
+                      func=lambda: sender.offset, **labels)
+
+    def _process_packet(self, data, addr, recv_time):
+        header = netproto.decode_header(data)
+        offset_sample = recv_time - header.send_time
+        sender = self._senders.get(addr)
+        if sender is None:
+            sender = SenderState(header.seq, offset_sample)
+            self._senders[addr] = sender
+            self._register_sender_metrics(addr, sender)
+        sender.update(header.seq, offset_sample)
+        base_time = header.send_time + sender.offset
+        put_nowait = self._queue.put_nowait
+        if header.record_type == netproto.RECORD_TRIGGER:
+            for offset, trigger, on, velocity in \
+                        netproto.iter_trigger_records(data, header):
+                put_nowait(NetEvent(("TRIGGER", trigger), on, velocity,
+                                    base_time + offset))
+        elif header.record_type == netproto.RECORD_MIDI:
+            for offset, midi_bytes in netproto.iter_midi_records(data,
+                                                                 header):
+                if len(midi_bytes) < 3:
+                    continue
+                status = midi_bytes[0] & 0xf0
+                if status == 0x90 and midi_bytes[2]:
+                    on = True
+                elif status == 0x80 or status == 0x90:
+                    on = False
+                else:
+                    continue
+                put_nowait(NetEvent(("NOTE", midi_bytes[1]), on,
+                                    midi_bytes[2], base_time + offset))
+        else:
+            raise netproto.PacketError("Unknown record type: {}"
+                                       .format(header.record_type))
+
+    async def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            event = await self._queue.get()
+            if self._done:
+                raise StopAsyncIteration
+            if event is None:
+                continue
+            self.events_metric.inc()
+            handler = self._event_map.get(event.key)
+            if handler:
+                msg = handler.translate(event)
+                if msg is not None:
+                    return msg
+
+    async def get_key(self):
+        """Read single trigger or note from the network."""
+        self.start()
+        try:
+            while True:
+                event = await self._queue.get()
+                if event is None:
+                    return None
+                if event.on:
+                    return "{}_{}".format(*event.key)
+        finally:
+            self.main_loop.remove_reader(self._socket.fileno())
+
+def input_device_factory(config, section, main_loop):
+    if "listen" not in config[section]:
+        raise InputDeviceLoadError("[{}]: 'listen' address not provided"
+                                   .format(section))
+    yield NetInputDevice(config, section, main_loop)
@@ -30,6 +30,7 @@ import os
 import sys
 import termios
 
+from .. import metrics
 from .base import EventHandler, BaseInputDevice, InputDeviceLoadError
 
 logger = logging.getLogger("input.terminal")
@@ -39,7 +40,10 @@ class CursesKeyHandler(EventHandler):
         return "on"
 
 class TerminalDevice(BaseInputDevice):
+    # there are no key release events, release notes automatically
+    KEYMAP_DEFAULTS = dict(BaseInputDevice.KEYMAP_DEFAULTS, duration="500")
     name = "Terminal"
+    release_events = False
     def __init__(self, config, section, main_loop):
         self._done = False
         self._stdscr = None
@@ -47,7 +51,11 @@ class TerminalDevice(BaseInputDevice):
         self._event_map = {}
         self._saved_tc_attrs = None
         self._curses_tc_attrs = None
+        self._debug = logger.isEnabledFor(logging.DEBUG)
         BaseInputDevice.__init__(self, config, section, main_loop)
+        metrics.gauge("badumtss_input_queue_depth",
+                      "Input events waiting for processing",
+                      func=lambda: self._queue.qsize(), device=self.name)
 
     def __del__(self):
         if not self._done:
@@ -55,21 +63,25 @@ class TerminalDevice(BaseInputDevice):
         if self._stdscr:
             self._finalize_terminal()
 
-    def load_keymap(self):
-        """Process `self.keymap_config` ConfigParser object to build internal
-        input event to EventHandler object mapping.
+    def load_keymap(self, keymap_config):
+        """Process `keymap_config` ConfigParser object to build input event
+        to EventHandler object mapping.
+
+        Return the new mapping.
         """
-        for section in self.keymap_config:
+        event_map = {}
+        for section in keymap_config:
             if len(section) == 1:
                 key = section
             elif section.startswith("KEY_"):
                 key = section
             else:
                 continue
-            settings = self.keymap_config[section]
+            settings = keymap_config[section]
             handler = CursesKeyHandler(self, section, settings)
-            self._event_map[key] = handler
-        logger.debug("event map: %r", self._event_map)
+            event_map[key] = handler
+        logger.debug("event map: %r", event_map)
+        return event_map
 
     def _initialize_terminal(self):
         """Initialize curses terminal."""
@@ -142,7 +154,8 @@ class TerminalDevice(BaseInputDevice):
 
     def _reader(self):
         """Handle terminal input."""
-        logger.debug("input pending")
+        if self._debug:
+            logger.debug("input pending")
         if self._done:
             logger.debug("   ...but we are done, flushing")
             os.read(sys.stdin.fileno())
@@ -169,13 +182,15 @@ class TerminalDevice(BaseInputDevice):
                 raise StopAsyncIteration
             if key is None:
                 continue
-            logger.debug("key: %r", key)
+            self.events_metric.inc()
+            if self._debug:
+                logger.debug("key: %r", key)
             handler = self._event_map.get(key)
             if handler:
                 msg = handler.translate(key)
                 if msg is not None:
                     return msg
-            else:
+            elif self._debug:
                 logger.debug("no handler for %r", key)
 
 def input_device_factory(config, section, main_loop):
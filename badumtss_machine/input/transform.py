@@ -0,0 +1,158 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Keymap binding transforms compiled to lookup tables.
+
+Velocity curves, transposition, velocity layers and note stacks of
+a binding are all resolved at keymap load time into a single 128-entry
+table, indexed by the input velocity, of notes to play.
+"""
+
+import logging
+import math
+
+from ..util import parse_integer_list
+
+logger = logging.getLogger("input.transform")
+
+class TransformError(ValueError):
+    """Raised on invalid transform settings."""
+    pass
+
+def _clamp_velocity(value):
+    return max(0, min(127, int(round(value))))
+
+def _interpolate(points, value):
+    """Linear interpolation between sorted (x, y) points."""
+    if value <= points[0][0]:
+        return points[0][1]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        if value <= x2:
+            return y1 + (y2 - y1) * (value - x1) / (x2 - x1)
+    return points[-1][1]
+
+def velocity_curve_table(spec):
+    """Build velocity lookup table from a `velocity_curve` setting.
+
+    Supported curves:
+
+    * `linear` – no change
+    * `exp[:K]` – exponential (softer) curve, K (default: 3) sets the
+      steepness
+    * `log[:K]` – logarithmic (harder) curve, K (default: 10) sets the
+      steepness
+    * `custom:IN:OUT,IN:OUT,…` – linear interpolation between given points
+
+    Non-zero input velocity always gives non-zero output, so a note-on
+    never turns into a note-off.
+    """
+    kind, _, arg = spec.strip().partition(":")
+    try:
+        if kind == "linear":
+            func = lambda x: x
+        elif kind == "exp":
+            k = float(arg) if arg else 3.0
+            func = lambda x: (math.exp(k * x) - 1) / (math.exp(k) - 1)
+        elif kind == "log":
+            k = float(arg) if arg else 10.0
+            func = lambda x: math.log1p(k * x) / math.log1p(k)
+        elif kind == "custom":
+            points = []
+            for point in arg.split(","):
+                x, y = point.split(":")
+                points.append((float(x) / 127, float(y) / 127))
+            points.sort()
+            if len(points) < 2:
+                raise TransformError("at least two points needed")
+            func = lambda x: _interpolate(points, x)
+        else:
+            raise TransformError("unknown velocity curve: {!r}".format(kind))
+        # evaluated here, so e.g. `exp:0` fails as an invalid setting
+        table = [0]
+        for velocity in range(1, 128):
+            table.append(max(1, _clamp_velocity(127 * func(velocity / 127))))
+    except (ValueError, ArithmeticError) as err:
+        raise TransformError("invalid velocity curve {!r}: {}"
+                             .format(spec, err))
+    return table
+
+def parse_layers(spec):
+    """Parse `layers` setting: `VELOCITIES:NOTES;VELOCITIES:NOTES…`.
+
+    Return list of (velocity set, note list) pairs.
+    """
+    layers = []
+    for layer in spec.split(";"):
+        layer = layer.strip()
+        if not layer:
+            continue
+        try:
+            velocities, notes = layer.split(":", 1)
+        except ValueError:
+            raise TransformError("invalid layer: {!r}".format(layer))
+        layers.append((set(parse_integer_list(velocities)),
+                       list(parse_integer_list(notes))))
+    return layers
+
+def compile_note_table(settings):
+    """Compile note related binding settings into a note table.
+
+    The result is a 128-element list indexed by the input velocity, each
+    element is a tuple of (relative, note, velocity) tuples – one for each
+    note to play. When `relative` is true the note is an offset to add to
+    the note provided by the event handler (for `note=varies`).
+    """
+    note = settings["note"]
+    relative = (note == "varies")
+    if relative:
+        note = 0
+    else:
+        note = int(note)
+    transpose = int(settings.get("transpose", 0))
+    curve = velocity_curve_table(settings.get("velocity_curve", "linear"))
+    layers = parse_layers(settings.get("layers", ""))
+    stack = settings.get("stack", "")
+    stack = list(parse_integer_list(stack)) if stack else []
+    table = []
+    for velocity in range(128):
+        notes = []
+        for layer_velocities, layer_notes in layers:
+            if velocity in layer_velocities:
+                notes += [(False, n) for n in layer_notes]
+        if not notes:
+            notes.append((relative, note))
+        notes += [(False, n) for n in stack]
+        out_velocity = curve[velocity]
+        entry = []
+        for n_relative, n in notes:
+            n += transpose
+            if not n_relative and not 0 <= n <= 127:
+                continue
+            item = (n_relative, n, out_velocity)
+            if item not in entry:
+                entry.append(item)
+        table.append(tuple(entry))
+    return table
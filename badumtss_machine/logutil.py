@@ -0,0 +1,142 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Logging set-up keeping log I/O off the event loop thread."""
+
+import logging
+import queue
+import time
+
+from logging.handlers import QueueHandler, QueueListener
+
+from . import metrics
+
+# log message arguments which cannot change after the logging call
+IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None))
+
+class ArgSnapshot(object):
+    """String forms of a log message argument taken at the logging call."""
+    __slots__ = ("_str", "_repr")
+    def __init__(self, value):
+        self._str = str(value)
+        self._repr = repr(value)
+
+    def __str__(self):
+        return self._str
+
+    def __repr__(self):
+        return self._repr
+
+def snapshot_arg(value):
+    """Return `value` or, if it may change later, its ArgSnapshot."""
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value
+    if isinstance(value, tuple) and all(isinstance(item, IMMUTABLE_TYPES)
+                                        for item in value):
+        # e.g. MIDI messages
+        return value
+    return ArgSnapshot(value)
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler leaving message formatting to the listener thread.
+
+    The `%` formatting of the message (and of the handler formats) is the
+    costly part of a logging call, so it is not done on the event loop
+    thread. Arguments which may change before the listener formats the
+    record (lists, dicts, objects describing live state) are replaced with
+    their string forms taken at the logging call, so the message shows
+    the state at that moment and the listener does not touch objects
+    owned by the loop thread.
+    """
+    def prepare(self, record):
+        args = record.args
+        if args:
+            if isinstance(args, dict):
+                record.args = {key: snapshot_arg(value)
+                               for key, value in args.items()}
+            else:
+                record.args = tuple(snapshot_arg(arg) for arg in args)
+        return record
+
+class RateLimitFilter(logging.Filter):
+    """Limit number of debug (or lower) messages per second.
+
+    A token bucket of `burst` records, refilled at `rate` records per
+    second. The number of messages dropped is appended to the next message
+    passed.
+    """
+    def __init__(self, rate, burst=None, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or rate
+        self.level = level
+        self.suppressed = 0
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            self.suppressed += 1
+            return False
+        self._tokens -= 1
+        if self.suppressed:
+            record.msg = "{} [{} debug messages suppressed]".format(
+                                                record.msg, self.suppressed)
+            self.suppressed = 0
+        return True
+
+def start_queue_logging(debug_rate=None):
+    """Move the root logger handlers to a listener thread.
+
+    Records are passed to the thread through a queue, so logging calls
+    never wait for I/O. If `debug_rate` is given, debug messages are
+    limited to that many per second.
+
+    Return the started QueueListener, to be stopped on exit.
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.Queue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    if debug_rate:
+        rate_filter = RateLimitFilter(debug_rate)
+        queue_handler.addFilter(rate_filter)
+        metrics.counter("badumtss_log_suppressed_total",
+                        "Debug messages dropped by rate limiting",
+                        func=lambda: rate_filter.suppressed)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers,
+                             respect_handler_level=True)
+    listener.start()
+    return listener
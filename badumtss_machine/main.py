@@ -36,16 +36,29 @@ import sys
 
 from configparser import ConfigParser, ExtendedInterpolation
 
+from .controlserver import start_control_server
 from .players import player_factory
-from .input import input_devices_generator, probe_input_drivers
+from .input import input_devices_generator, input_devices_generator_single
+from .input import probe_input_devices
+from .input import probe_input_drivers
+from .input import InputDeviceLoadError, UnknownDeviceTypeError
+from .logutil import start_queue_logging
+from .metrics import start_metrics_server
+from .notestate import NoteStateTracker
+from .profiling import start_profiler, DEFAULT_OUTPUT
+from .scheduler import Scheduler
+from .watchdog import start_watchdog
 from .wizard import keymap_wizard
 from . import control
+from . import metrics
 from . import midi
+from . import watchdog
 
 logger = logging.getLogger()
 
 PKG_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_LOGGING_CONFIG = os.path.join(PKG_DIR, "logging.conf")
+CONFIG_FILE = "badumtss.conf"
 
 INTRO_NOTES = [0, 38, 38, 0, 49]
 
@@ -57,15 +70,72 @@ async def play_intro(player):
             player.handle_message(msg)
         await asyncio.sleep(0.2)
 
+def make_router(loop, input_device, player):
+    """Return function passing a message from `input_device` to `player`."""
+    messages_metric = metrics.counter("badumtss_messages_total",
+                                      "Messages routed from input devices",
+                                      device=input_device.name)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    busy_player = busy_player_of(player)
+    def route(msg):
+        if debug:
+            logger.debug("msg: %r", msg)
+        # the device may be already marked by its event reading code
+        prev_device = watchdog.busy_device
+        watchdog.busy_device = input_device
+        watchdog.busy_player = busy_player
+        try:
+            if isinstance(msg, midi.MidiMessage):
+                messages_metric.inc()
+                player.handle_message(msg, input_device)
+            elif isinstance(msg, list):
+                messages_metric.inc(len(msg))
+                for item in msg:
+                    player.handle_message(item, input_device)
+            elif isinstance(msg, control.Quit):
+                loop.stop()
+            else:
+                logger.warning("Unknown input: %r", msg)
+        finally:
+            watchdog.busy_device = prev_device
+            watchdog.busy_player = None
+    return route
+
+def busy_player_of(player):
+    """Return the player to be reported by the watchdog for `player`."""
+    if isinstance(player, NoteStateTracker):
+        return player.player
+    return player
+
+def make_sink(player):
+    """Return scheduler sink passing delayed messages to `player`."""
+    handle_message = player.handle_message
+    busy_player = busy_player_of(player)
+    def sink(msg, source=None):
+        watchdog.busy_device = source
+        watchdog.busy_player = busy_player
+        try:
+            handle_message(msg, source)
+        finally:
+            watchdog.busy_device = None
+            watchdog.busy_player = None
+    return sink
+
 async def route_messages(loop, input_device, player):
-    async for msg in input_device:
-        logger.debug("msg: %r", msg)
-        if isinstance(msg, midi.MidiMessage):
-            player.handle_message(msg)
-        elif isinstance(msg, control.Quit):
-            loop.stop()
+    route = make_router(loop, input_device, player)
+    try:
+        if input_device.direct_dispatch:
+            await input_device.dispatch(route)
         else:
-            logger.warning("Unknown input: %r", msg)
+            async for msg in input_device:
+                route(msg)
+    except OSError as err:
+        metrics.counter("badumtss_input_devices_lost_total",
+                        "Input devices lost").inc()
+        logger.warning("Input device %r lost: %s", input_device.name, err)
+    finally:
+        # release any notes still held on this device
+        player.all_notes_off(input_device)
 
 def command_args():
     parser = argparse.ArgumentParser(
@@ -82,6 +152,17 @@ def command_args():
     parser.add_argument("--logging-config", metavar="FILENAME", nargs=1,
                         default=DEFAULT_LOGGING_CONFIG,
                         help="Alternative logging configuration")
+    parser.add_argument("--debug-rate", metavar="N", type=float, default=200,
+                        help="Limit debug messages to N per second"
+                             " (0 – no limit)")
+    parser.add_argument("--profile", nargs="?", const="sampling",
+                        choices=["sampling", "cprofile"],
+                        help="Profile the session (sampling by default)")
+    parser.add_argument("--profile-output", metavar="FILENAME",
+                        help="Profile output file (collapsed stacks"
+                             " for sampling, pstats for cprofile)")
+    parser.add_argument("--profile-interval", metavar="MS", type=float,
+                        default=5, help="Sampling profiler interval")
     parser.add_argument("--player", "-p", metavar="SECTION",
                         help="Select specific player from config file")
     parser.add_argument("--input-device", "-i", metavar="SECTION",
@@ -96,67 +177,293 @@ def command_args():
         logging.getLogger().setLevel(args.log_level)
     return args
 
-def play_input(args, loop, input_devices, player):
-    """Play incoming input on the MIDI player."""
-    routers = []
+def load_config():
+    """Read the application configuration."""
+    config = ConfigParser(interpolation=ExtendedInterpolation(),
+                          default_section="defaults")
+    config.add_section("paths")
+    config["paths"] = { "pkgdir": PKG_DIR }
+    config.read(CONFIG_FILE)
+    return config
+
+def is_enabled(config, section):
+    """Check if `section` exists in `config` and is not disabled."""
+    return section in config and not config[section].getboolean("disabled",
+                                                                 False)
+
+def section_changed(old_config, config, section):
+    """Check if settings of `section` differ between the configs."""
+    if not old_config.has_section(section) or not config.has_section(section):
+        return True
+    return (old_config.items(section, raw=True)
+            != config.items(section, raw=True))
+
+class Session(object):
+    """Input devices routed to the player.
+
+    Devices may be added, removed and reconfigured while playing.
+    """
+    def __init__(self, args, loop, config, input_devices, player):
+        self.args = args
+        self.loop = loop
+        self.config = config
+        self.input_devices = input_devices
+        self.player = player
+        self.scheduler = None
+        self._routers = {}
+        self._reload_lock = asyncio.Lock()
+        self._reloads_metric = metrics.counter("badumtss_reloads_total",
+                                               "Configuration reloads")
+        self._reload_errors_metric = metrics.counter(
+                                        "badumtss_reload_errors_total",
+                                        "Failed configuration reloads")
+
+    def add_device(self, input_device):
+        """Start routing messages from `input_device`."""
+        if input_device not in self.input_devices:
+            self.input_devices.append(input_device)
+        input_device.scheduler = self.scheduler
+        router = self.loop.create_task(route_messages(self.loop,
+                                                      input_device,
+                                                      self.player))
+        self._routers[input_device] = router
+        input_device.start()
+
+    def remove_device(self, input_device):
+        """Stop routing messages from `input_device` and stop the device."""
+        router = self._routers.pop(input_device, None)
+        if router is not None:
+            router.cancel()
+        self.input_devices.remove(input_device)
+        input_device.stop()
+
+    def close(self):
+        """Stop routing messages."""
+        routers = list(self._routers.values())
+        self._routers.clear()
+        for router in routers:
+            router.cancel()
+            try:
+                self.loop.run_until_complete(router)
+            except asyncio.CancelledError:
+                pass
+
+    def request_reload(self):
+        """Schedule configuration reload (e.g. from a signal handler)."""
+        logger.info("Reloading configuration")
+        task = self.loop.create_task(self.reload())
+        task.add_done_callback(self._reload_done)
+
+    def _reload_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Configuration reload failed: %s", task.exception())
+
+    async def reload(self):
+        """Reload configuration and keymaps without stopping playback.
+
+        Configuration and keymap files are read in worker threads, the new
+        keymaps are then built and swapped in the input devices. Devices
+        from removed, disabled or changed config sections are stopped.
+        Enabled sections without a device (new, changed or failed before)
+        are probed and loaded again. The player is not restarted.
+        """
+        async with self._reload_lock:
+            try:
+                await self._reload()
+            except Exception:
+                self._reload_errors_metric.inc()
+                raise
+            self._reloads_metric.inc()
+
+    async def _reload(self):
+        loop = self.loop
+        old_config = self.config
+        config = await loop.run_in_executor(None, load_config)
+        probe_input_drivers(config)
+        prepared = []
+        for input_device in list(self.input_devices):
+            section = input_device.config_section
+            if not is_enabled(config, section):
+                logger.info("[%s]: removed, closing %r",
+                            section, input_device.name)
+                self.remove_device(input_device)
+                continue
+            if (not self.args.input_device
+                    and section_changed(old_config, config, section)):
+                logger.info("[%s]: changed, closing %r",
+                            section, input_device.name)
+                self.remove_device(input_device)
+                continue
+            prepared.append((input_device,
+                             loop.run_in_executor(None,
+                                                  input_device.prepare_reload,
+                                                  config)))
+        for input_device, future in prepared:
+            try:
+                prepared_keymap = await future
+            except Exception as err:
+                logger.error("[%s]: cannot load new keymap for %r: %s",
+                             input_device.config_section, input_device.name,
+                             err)
+                continue
+            if input_device not in self.input_devices:
+                # lost in the meantime
+                continue
+            try:
+                msgs = input_device.apply_reload(prepared_keymap)
+            except Exception as err:
+                logger.error("[%s]: cannot load new keymap for %r: %s",
+                             input_device.config_section, input_device.name,
+                             err)
+                logger.debug("Exception:", exc_info=True)
+                continue
+            for msg in msgs:
+                self.player.handle_message(msg, input_device)
+        if isinstance(self.player, NoteStateTracker):
+            self.player.configure(config)
+        self.config = config
+        if self.args.input_device:
+            return
+        loaded = set(input_device.config_section
+                     for input_device in self.input_devices)
+        sections = [section for section in config.sections()
+                    if is_enabled(config, section) and section not in loaded]
+        await probe_input_devices(config, loop, sections=sections)
+        for section in sections:
+            try:
+                for input_device in input_devices_generator_single(config,
+                                                                   section,
+                                                                   loop):
+                    logger.info("[%s]: new input device %r",
+                                section, input_device.name)
+                    self.add_device(input_device)
+            except UnknownDeviceTypeError:
+                continue
+            except InputDeviceLoadError as err:
+                logger.info("%s", err)
+            except Exception as err:
+                logger.warning("[%s]: cannot load event device handler: %s",
+                               section, err)
+                logger.debug("Exception:", exc_info=True)
+
+    def panic(self):
+        """Release all sounding notes."""
+        self.player.all_notes_off()
+
+    def status(self):
+        """Return a short status description."""
+        return "devices: {}".format(", ".join(repr(input_device.name)
+                                              for input_device
+                                              in self.input_devices))
+
+def play_input(args, loop, config, input_devices, player, scheduler,
+               intro=None):
+    """Play incoming input on the MIDI player.
+
+    `intro` is the intro playing task to wait for."""
+    session = Session(args, loop, config, input_devices, player)
+    session.scheduler = scheduler
+    control_server = None
     try:
-        if not args.no_intro:
-            loop.run_until_complete(play_intro(player))
+        if intro is not None:
+            loop.run_until_complete(intro)
         if not input_devices:
             logger.error("No input device found, exiting")
             return
         for input_device in input_devices:
-            router = loop.create_task(route_messages(loop,
-                                                     input_device,
-                                                     player))
-            routers.append(router)
-            input_device.start()
+            session.add_device(input_device)
+        loop.add_signal_handler(signal.SIGHUP, session.request_reload)
+        control_server = start_control_server(config, loop, {
+                "reload": session.reload,
+                "panic": session.panic,
+                "status": session.status,
+                "quit": loop.stop,
+                })
         loop.run_forever()
     finally:
-        for router in routers:
-            router.cancel()
-            try:
-                loop.run_until_complete(router)
-            except asyncio.CancelledError:
-                pass
+        loop.remove_signal_handler(signal.SIGHUP)
+        if control_server:
+            control_server.close()
+        session.close()
 
-def main():
-    locale.setlocale(locale.LC_ALL, '')
-    args = command_args()
-    config = ConfigParser(interpolation=ExtendedInterpolation(),
-                          default_section="defaults")
-    config.add_section("paths")
-    config["paths"] = { "pkgdir": PKG_DIR }
-    config.read("badumtss.conf")
+def run(args):
+    """Run the application with parsed command line arguments."""
+    config = load_config()
 
     probe_input_drivers(config)
 
     loop = asyncio.get_event_loop()
+    metrics_server = None
+    watchdog = None
     try:
         loop.add_signal_handler(signal.SIGINT, loop.stop)
         loop.add_signal_handler(signal.SIGTERM, loop.stop)
 
+        metrics_server = start_metrics_server(config, loop)
+        watchdog = start_watchdog(config, loop)
+
         player = player_factory(config, loop, section=args.player)
         if not player:
             logger.error("No MIDI player available.")
             if not args.keymap_wizard:
                 return
+        else:
+            player = NoteStateTracker(config, player, loop)
 
-        input_devices = list(input_devices_generator(config,
-                                                     loop,
-                                                     section=args.input_device))
         player.start()
+        input_devices = []
+        intro = None
         try:
+            if not args.no_intro and not args.keymap_wizard:
+                # play the intro while the devices are being set up
+                intro = loop.create_task(play_intro(player))
+            loop.run_until_complete(probe_input_devices(
+                                                config, loop,
+                                                section=args.input_device))
+            input_devices = list(input_devices_generator(
+                                                config, loop,
+                                                section=args.input_device))
+            scheduler = None
+            if player:
+                scheduler = Scheduler(loop, make_sink(player))
+                metrics.gauge("badumtss_scheduled_timers",
+                              "Scheduled calls pending",
+                              func=lambda: scheduler.pending)
+                for input_device in input_devices:
+                    input_device.scheduler = scheduler
             if args.keymap_wizard:
                 keymap_wizard(args, loop, input_devices, player)
             else:
-                play_input(args, loop, input_devices, player)
+                play_input(args, loop, config, input_devices, player,
+                           scheduler, intro)
         finally:
+            if intro is not None:
+                intro.cancel()
             for input_device in input_devices:
                 input_device.stop()
             player.stop()
     finally:
+        if watchdog:
+            watchdog.stop()
+        if metrics_server:
+            metrics_server.close()
         loop.close()
 
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    args = command_args()
+    log_listener = start_queue_logging(args.debug_rate)
+    profiler = None
+    if args.profile:
+        profiler = start_profiler(args.profile,
+                                  args.profile_interval / 1000.0)
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.stop(args.profile_output
+                          or DEFAULT_OUTPUT[args.profile])
+        log_listener.stop()
+
 if __name__ == "__main__":
     main()
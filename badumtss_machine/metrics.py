@@ -0,0 +1,242 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Runtime metrics and Prometheus-style text exposition.
+
+Metric objects are updated with plain attribute operations, no locks are
+involved, so updating them is cheap enough for the hot paths. Each metric
+should be updated from a single thread only. Values are read only when
+the metrics are exported.
+"""
+
+import asyncio
+import logging
+
+from array import array
+from bisect import bisect_left
+
+from .util import start_stream_server
+
+logger = logging.getLogger("metrics")
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+class Metric(object):
+    """Single metric value.
+
+    If `func` is given, it is called to get the current value on export,
+    for values already maintained elsewhere.
+    """
+    metric_type = "untyped"
+    __slots__ = ("name", "labels", "value", "func")
+    def __init__(self, name, labels, func=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.func = func
+
+    def get_value(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+    def format_labels(self, extra=None):
+        labels = sorted(self.labels.items())
+        if extra:
+            labels.append(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(key, _escape(value))
+                              for key, value in labels) + "}"
+
+    def samples(self):
+        """Return exposition format lines for the metric."""
+        return ["{}{} {}".format(self.name, self.format_labels(),
+                                 self.get_value())]
+
+class Counter(Metric):
+    """Monotonically increasing counter."""
+    metric_type = "counter"
+    __slots__ = ()
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+    metric_type = "gauge"
+    __slots__ = ()
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets.
+
+    Bucket counters and the sum are kept in preallocated arrays, so
+    `observe` does not keep any new objects (only temporary numbers are
+    created) and may be used from a realtime thread.
+    """
+    metric_type = "histogram"
+    __slots__ = ("bounds", "counts", "_sum")
+    def __init__(self, name, labels, bounds, func=None):
+        super().__init__(name, labels, func)
+        self.bounds = tuple(sorted(bounds))
+        self.counts = array("L", [0] * (len(self.bounds) + 1))
+        self._sum = array("d", [0.0])
+
+    @property
+    def sum(self):
+        return self._sum[0]
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self._sum[0] += value
+
+    def samples(self):
+        lines = []
+        total = 0
+        labels = self.format_labels
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            total += count
+            lines.append("{}_bucket{} {}".format(self.name,
+                                                 labels(("le", bound)),
+                                                 total))
+        lines.append("{}_sum{} {}".format(self.name, labels(), self.sum))
+        lines.append("{}_count{} {}".format(self.name, labels(), total))
+        return lines
+
+class Registry(object):
+    """Collection of metrics."""
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._types = {}
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            if self._types.setdefault(name, cls) is not cls:
+                raise ValueError("Metric {!r} already registered as {}"
+                                 .format(name, self._types[name].__name__))
+            metric = cls(name, labels, **kwargs)
+            self._metrics[key] = metric
+            self._help.setdefault(name, help_text)
+        elif kwargs.get("func") is not None:
+            metric.func = kwargs["func"]
+        return metric
+
+    def counter(self, name, help_text, func=None, **labels):
+        """Get or create a counter."""
+        return self._get(Counter, name, help_text, labels, func=func)
+
+    def gauge(self, name, help_text, func=None, **labels):
+        """Get or create a gauge."""
+        return self._get(Gauge, name, help_text, labels, func=func)
+
+    def histogram(self, name, help_text, bounds, **labels):
+        """Get or create a histogram with given bucket upper bounds."""
+        return self._get(Histogram, name, help_text, labels, bounds=bounds)
+
+    def unregister(self, metric):
+        """Remove a metric from the registry."""
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        self._metrics.pop(key, None)
+
+    def render(self):
+        """Return all metrics in the text exposition format."""
+        lines = []
+        by_name = {}
+        for metric in list(self._metrics.values()):
+            by_name.setdefault(metric.name, []).append(metric)
+        for name in sorted(by_name):
+            lines.append("# HELP {} {}".format(name, self._help[name]))
+            lines.append("# TYPE {} {}".format(
+                                        name, self._types[name].metric_type))
+            for metric in by_name[name]:
+                try:
+                    lines += metric.samples()
+                except Exception as err:
+                    logger.debug("Cannot get %r value: %s", name, err)
+        lines.append("")
+        return "\n".join(lines)
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+unregister = REGISTRY.unregister
+
+class MetricsProtocol(asyncio.Protocol):
+    """Minimal HTTP server protocol, serving the metrics for any request."""
+    def __init__(self, registry):
+        self._registry = registry
+        self._transport = None
+        self._data = b""
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        self._data += data
+        if b"\r\n\r\n" not in self._data and b"\n\n" not in self._data:
+            if len(self._data) > 8192:
+                self._transport.close()
+            return
+        body = self._registry.render().encode("utf-8")
+        header = ("HTTP/1.0 200 OK\r\n"
+                  "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                  "Content-Length: {}\r\n"
+                  "Connection: close\r\n"
+                  "\r\n").format(len(body)).encode("ascii")
+        self._transport.write(header + body)
+        self._transport.close()
+
+def start_metrics_server(config, loop, registry=REGISTRY):
+    """Start metrics exporter if configured in the `[metrics]` section.
+
+    Return the asyncio Server object or None.
+    """
+    if "metrics" not in config:
+        return None
+    section = config["metrics"]
+    if section.getboolean("disabled", False):
+        return None
+    listen = section.get("listen", "127.0.0.1:9109")
+    factory = lambda: MetricsProtocol(registry)
+    server = start_stream_server(loop, factory, listen, "metrics")
+    if server is None:
+        return None
+    logger.info("Serving metrics on %r", listen)
+    return server
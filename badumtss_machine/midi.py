@@ -33,8 +33,18 @@ class MidiMessage(metaclass=ABCMeta):
     def get_bytes(self):
         raise NotImplementedError
 
+def _message_tuple(name, fields):
+    """Create a namedtuple base class for a MIDI message.
+
+    An extra, optional, `timestamp` field is added – time (as returned by
+    `time.time()`) the input event causing the message was captured.
+    """
+    base = namedtuple(name, fields + " timestamp")
+    base.__new__.__defaults__ = (None,)
+    return base
+
 @MidiMessage.register
-class NoteOn(namedtuple("NoteOn", "channel note velocity")):
+class NoteOn(_message_tuple("NoteOn", "channel note velocity")):
     __slots__ = ()
     def get_bytes(self):
         return bytes([
@@ -44,7 +54,7 @@ class NoteOn(namedtuple("NoteOn", "channel note velocity")):
                       ])
 
 @MidiMessage.register
-class NoteOff(namedtuple("NoteOff", "channel note velocity")):
+class NoteOff(_message_tuple("NoteOff", "channel note velocity")):
     __slots__ = ()
     def get_bytes(self):
         return bytes([
@@ -52,3 +62,43 @@ class NoteOff(namedtuple("NoteOff", "channel note velocity")):
                       self.note & 0x7f,
                       self.velocity & 0x7f
                       ])
+
+@MidiMessage.register
+class ControlChange(_message_tuple("ControlChange", "channel controller value")):
+    __slots__ = ()
+    def get_bytes(self):
+        return bytes([
+                      0xb0 | ((self.channel - 1) & 0x0f),
+                      self.controller & 0x7f,
+                      self.value & 0x7f
+                      ])
+
+@MidiMessage.register
+class ProgramChange(_message_tuple("ProgramChange", "channel program")):
+    __slots__ = ()
+    def get_bytes(self):
+        return bytes([
+                      0xc0 | ((self.channel - 1) & 0x0f),
+                      self.program & 0x7f
+                      ])
+
+@MidiMessage.register
+class PitchBend(_message_tuple("PitchBend", "channel value")):
+    """Pitch bend, value from -8192 to 8191 (0 – no bend)."""
+    __slots__ = ()
+    def get_bytes(self):
+        value = self.value + 8192
+        return bytes([
+                      0xe0 | ((self.channel - 1) & 0x0f),
+                      value & 0x7f,
+                      (value >> 7) & 0x7f
+                      ])
+
+@MidiMessage.register
+class ChannelPressure(_message_tuple("ChannelPressure", "channel pressure")):
+    __slots__ = ()
+    def get_bytes(self):
+        return bytes([
+                      0xd0 | ((self.channel - 1) & 0x0f),
+                      self.pressure & 0x7f
+                      ])
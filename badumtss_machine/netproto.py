@@ -0,0 +1,134 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Network packet format for MIDI messages and triggers.
+
+Every packet (UDP datagram or Unix datagram) starts with a 20 byte header,
+all numbers are big-endian:
+
+    ======  =====  ===================================================
+    offset  size   content
+    ======  =====  ===================================================
+    0       4      magic: ``BDTS``
+    4       1      protocol version: 1
+    5       1      record type: 1 – MIDI messages, 2 – triggers
+    6       2      number of records
+    8       4      sequence number (per sender, wrapping at 2**32)
+    12      8      send time: IEEE 754 double, seconds since the Epoch
+    ======  =====  ===================================================
+
+followed by a number of 8 byte records. Each record starts with a signed
+32-bit time offset, in microseconds, of the moment the event was captured
+relative to the send time (so it is usually negative or zero).
+
+MIDI message record:
+
+    ======  =====  ===================================================
+    0       4      time offset
+    4       1      length of the MIDI message (1-3)
+    5       3      MIDI message bytes, padded with zeros
+    ======  =====  ===================================================
+
+Trigger record:
+
+    ======  =====  ===================================================
+    0       4      time offset
+    4       2      trigger number
+    6       1      state: 0 – off, 1 – on
+    7       1      velocity (0-127)
+    ======  =====  ===================================================
+"""
+
+import socket
+import struct
+
+from collections import namedtuple
+
+MAGIC = b"BDTS"
+VERSION = 1
+
+RECORD_MIDI = 1
+RECORD_TRIGGER = 2
+
+HEADER = struct.Struct(">4sBBHId")
+MIDI_RECORD = struct.Struct(">iB3s")
+TRIGGER_RECORD = struct.Struct(">iHBB")
+OFFSET = struct.Struct(">i")
+RECORD_SIZE = 8
+
+# fits in a single ethernet frame
+MAX_PACKET_SIZE = 1472
+MAX_RECORDS = (MAX_PACKET_SIZE - HEADER.size) // RECORD_SIZE
+
+PacketHeader = namedtuple("PacketHeader", "record_type count seq send_time")
+
+class PacketError(ValueError):
+    """Raised on invalid packet."""
+    pass
+
+def parse_address(value):
+    """Parse an address from configuration.
+
+    `unix:PATH` gives a Unix socket address, `HOST:PORT` or `[HOST]:PORT`
+    an IPv4 or IPv6 address.
+
+    Return (address_family, address) tuple.
+    """
+    if value.startswith("unix:"):
+        return socket.AF_UNIX, value[5:]
+    host, sep, port = value.rpartition(":")
+    if not sep:
+        raise ValueError("Invalid address: {!r}".format(value))
+    port = int(port)
+    if host.startswith("[") and host.endswith("]"):
+        return socket.AF_INET6, (host[1:-1], port)
+    return socket.AF_INET, (host or "0.0.0.0", port)
+
+def decode_header(data):
+    """Decode and validate packet header."""
+    if len(data) < HEADER.size:
+        raise PacketError("Packet too short")
+    magic, version, record_type, count, seq, send_time = \
+                                            HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise PacketError("Bad magic")
+    if version != VERSION:
+        raise PacketError("Unsupported version: {}".format(version))
+    if len(data) < HEADER.size + count * RECORD_SIZE:
+        raise PacketError("Packet truncated")
+    return PacketHeader(record_type, count, seq, send_time)
+
+def iter_midi_records(data, header):
+    """Yield (time_offset, midi_bytes) from a MIDI messages packet."""
+    for offset, length, midi_bytes in MIDI_RECORD.iter_unpack(
+                data[HEADER.size:HEADER.size + header.count * RECORD_SIZE]):
+        yield offset * 1e-6, midi_bytes[:length]
+
+def iter_trigger_records(data, header):
+    """Yield (time_offset, trigger, on, velocity) from a triggers packet."""
+    for offset, trigger, state, velocity in TRIGGER_RECORD.iter_unpack(
+                data[HEADER.size:HEADER.size + header.count * RECORD_SIZE]):
+        yield offset * 1e-6, trigger, bool(state), velocity
@@ -0,0 +1,197 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Sounding notes tracking."""
+
+import logging
+
+from .players.base import Player
+from . import metrics
+from .util import parse_integer_list
+from . import midi
+
+logger = logging.getLogger("notestate")
+
+def iter_bits(bits):
+    """Yield numbers of bits set in an integer, lowest first."""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+class NoteStateTracker(Player):
+    """Keep track of sounding notes and pass messages to the real player.
+
+    Active notes are kept as one 128-bit integer per MIDI channel (bit N
+    set when note N is sounding), so duplicate detection, choke groups
+    and releasing everything are simple bit operations.
+
+    Configuration is read from the optional `[notes]` section (`duplicates`
+    – what to do with a NoteOn for a note already sounding: `retrigger`
+    or `drop`) and `[choke]` section (each option is a choke group in the
+    `channel:notes` format, e.g. `hihat=10:42,44,46`).
+    """
+    def __init__(self, config, player, main_loop):
+        super().__init__(config, "notes", main_loop)
+        self.player = player
+        self._active = [0] * 16
+        self._sources = {}
+        self._dropped_metric = metrics.counter(
+                                    "badumtss_notes_dropped_total",
+                                    "Duplicate note on messages dropped")
+        self._choked_metric = metrics.counter(
+                                    "badumtss_notes_choked_total",
+                                    "Notes released by choke groups")
+        metrics.gauge("badumtss_notes_active", "Notes currently sounding",
+                      func=lambda: sum(bin(bits).count("1")
+                                       for bits in self._active))
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply `[notes]` and `[choke]` settings from `config`.
+
+        May be called again to reload the settings. Sounding notes are
+        kept."""
+        if "notes" in config:
+            duplicates = config["notes"].get("duplicates", "retrigger")
+        else:
+            duplicates = "retrigger"
+        if duplicates not in ("retrigger", "drop"):
+            logger.warning("[notes]: unknown 'duplicates' mode: %r",
+                           duplicates)
+            duplicates = "retrigger"
+        if "choke" in config:
+            choke = self._load_choke_groups(config["choke"])
+        else:
+            choke = [{} for i in range(16)]
+        self.config = config
+        self._drop_duplicates = (duplicates == "drop")
+        self._choke = choke
+
+    def _load_choke_groups(self, section):
+        """Build per-channel note -> choked notes bit masks."""
+        choke_groups = [{} for i in range(16)]
+        for name, value in section.items():
+            if name in section.parser.defaults():
+                continue
+            try:
+                channel, notes = value.split(":", 1)
+                channel = int(channel)
+            except ValueError:
+                logger.warning("[choke]: invalid group %r: %r", name, value)
+                continue
+            mask = 0
+            for note in parse_integer_list(notes):
+                mask |= 1 << (note & 0x7f)
+            choke = choke_groups[(channel - 1) & 0x0f]
+            for note in iter_bits(mask):
+                choke[note] = choke.get(note, 0) | mask
+        return choke_groups
+
+    def start(self):
+        """Prepare the synthesizer for MIDI event processing."""
+        self.player.start()
+
+    def stop(self):
+        """Release all notes and shut down the synthesizer."""
+        self.all_notes_off()
+        self.player.stop()
+
+    def _clear_sources(self, chan_i, bits):
+        """Forget the sources of given notes of a channel (0-based)."""
+        for src_active in self._sources.values():
+            src_active[chan_i] &= ~bits
+
+    def _release(self, chan_i, bits):
+        """Send NoteOff for given notes of a channel (0-based)."""
+        self._active[chan_i] &= ~bits
+        self._clear_sources(chan_i, bits)
+        handle_message = self.player.handle_message
+        for note in iter_bits(bits):
+            handle_message(midi.NoteOff(chan_i + 1, note, 0))
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message.
+
+        `source` is the object (e.g. the input device) the message came
+        from, used to release notes of a single source only.
+        """
+        msg_type = type(msg)
+        if msg_type is midi.NoteOn and msg.velocity:
+            chan_i = (msg.channel - 1) & 0x0f
+            bit = 1 << (msg.note & 0x7f)
+            active = self._active[chan_i]
+            choke = self._choke[chan_i].get(msg.note)
+            if choke:
+                choked = active & choke & ~bit
+                if choked:
+                    self._choked_metric.inc()
+                    self._release(chan_i, choked)
+            if active & bit:
+                if self._drop_duplicates:
+                    self._dropped_metric.inc()
+                    return
+                self.player.handle_message(midi.NoteOff(msg.channel,
+                                                        msg.note, 0,
+                                                        msg.timestamp),
+                                           source)
+                self._clear_sources(chan_i, bit)
+            self._active[chan_i] |= bit
+            if source is not None:
+                try:
+                    self._sources[source][chan_i] |= bit
+                except KeyError:
+                    src_active = [0] * 16
+                    src_active[chan_i] = bit
+                    self._sources[source] = src_active
+        elif msg_type is midi.NoteOff or msg_type is midi.NoteOn:
+            chan_i = (msg.channel - 1) & 0x0f
+            bit = 1 << (msg.note & 0x7f)
+            if not self._active[chan_i] & bit:
+                # not sounding (already choked or released)
+                return
+            self._active[chan_i] &= ~bit
+            self._clear_sources(chan_i, bit)
+        self.player.handle_message(msg, source)
+
+    def all_notes_off(self, source=None):
+        """Send NoteOff for every sounding note.
+
+        If `source` is given, only the notes started by that source are
+        released.
+        """
+        if source is None:
+            self._sources.clear()
+            for chan_i, bits in enumerate(self._active):
+                if bits:
+                    self._release(chan_i, bits)
+            return
+        src_active = self._sources.pop(source, None)
+        if not src_active:
+            return
+        for chan_i, bits in enumerate(src_active):
+            bits &= self._active[chan_i]
+            if bits:
+                self._release(chan_i, bits)
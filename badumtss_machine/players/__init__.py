@@ -27,10 +27,20 @@
 
 import logging
 
-from .base import PlayerLoadError, UnknownPlayerTypeError
+from .base import PlayerLoadError, UnknownPlayerTypeError, PlayerGroup
 
 logger = logging.getLogger("players")
 
+# player types used in addition to the main player by default
+SECONDARY_PLAYER_TYPES = {"recorder"}
+
+def is_secondary(config, section):
+    """Check if a config section describes a secondary player – one used
+    together with the main player."""
+    player_type = section.split(":", 1)[0]
+    default = player_type in SECONDARY_PLAYER_TYPES
+    return config[section].getboolean("secondary", default)
+
 def player_factory_single(config, section, loop):
     """Create MIDI player from a configuration section.
 
@@ -53,36 +63,68 @@ def player_factory_single(config, section, loop):
         return JackPlayer(config, section, loop)
     elif player_type == "fluidsynth":
         try:
-            from .fluidsynth import FluidSynthPlayer
+            from .fluidsynth import FluidSynthPlayer, FluidSynthServerPlayer
         except ImportError as err:
             raise PlayerLoadError("[{}]: cannot load FluidSynth player: {}"
                                   .format(section, err))
+        if "server" in config[section]:
+            return FluidSynthServerPlayer(config, section, loop)
         return FluidSynthPlayer(config, section, loop)
+    elif player_type == "udp":
+        from .udp import UdpPlayer
+        return UdpPlayer(config, section, loop)
+    elif player_type == "recorder":
+        from .recorder import RecorderPlayer
+        return RecorderPlayer(config, section, loop)
     else:
         raise UnknownPlayerTypeError("[{}]: not a known player config"
                                      .format(section))
 
 def player_factory(config, loop, section=None):
-    """Create MIDI players from configuration, return the first one successfuly
-    created.
+    """Create MIDI players from configuration.
+
+    The player selected by `section` or the first main player successfuly
+    created is used together with all the secondary players configured.
+
+    Return a single Player object (PlayerGroup if there is more than one
+    player in use) or None if no main player could be created.
     """
+    main_player = None
+    secondary_players = []
     if section:
         try:
-            return player_factory_single(config, section, loop)
+            main_player = player_factory_single(config, section, loop)
         except PlayerLoadError as err:
             logger.error("%s", err)
             return None
-    for section in config:
-        if config[section].getboolean("disabled", False):
+    for p_section in config:
+        if p_section == section:
+            continue
+        if config[p_section].getboolean("disabled", False):
+            continue
+        secondary = is_secondary(config, p_section)
+        if main_player is not None and not secondary:
             continue
         try:
-            return player_factory_single(config, section, loop)
+            player = player_factory_single(config, p_section, loop)
         except UnknownPlayerTypeError:
             continue
         except PlayerLoadError as err:
             logger.info("%s", err)
+            continue
         except Exception as err:
             logger.warning("[%s]: cannot load event device handler: %s",
-                           section, err)
+                           p_section, err)
             logger.debug("Exception:", exc_info=True)
-    return None
+            continue
+        if secondary:
+            secondary_players.append(player)
+        else:
+            main_player = player
+    if main_player is None:
+        # secondary players are not much use alone
+        return None
+    elif not secondary_players:
+        return main_player
+    else:
+        return PlayerGroup([main_player] + secondary_players, loop)
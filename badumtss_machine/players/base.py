@@ -25,6 +25,8 @@
 
 """Common MIDI player code."""
 
+from .. import watchdog
+
 class PlayerError(Exception):
     """Raised on a player error."""
 
@@ -47,16 +49,43 @@ class Player(object):
         """Shut down the synthesizer after MIDI event processing."""
         pass
 
-    def handle_message(self, msg):
-        """Handle MIDI or control message."""
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message.
+
+        `source` is the object (e.g. the input device) the message came
+        from, if known.
+        """
         raise NotImplementedError
 
+class PlayerGroup(Player):
+    """Pass messages to a number of players."""
+    def __init__(self, players, main_loop):
+        self.main_loop = main_loop
+        self.players = list(players)
+
+    def start(self):
+        """Prepare the synthesizers for MIDI event processing."""
+        for player in self.players:
+            player.start()
+
+    def stop(self):
+        """Shut down the synthesizers after MIDI event processing."""
+        for player in self.players:
+            player.stop()
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message."""
+        for player in self.players:
+            watchdog.busy_player = player
+            player.handle_message(msg, source)
+        watchdog.busy_player = self
+
 class RawMidiPlayer(Player):
     """Base class for players that use raw MIDI messages."""
     def send(self, midi_bytes):
         """Send a MIDI message to the synthesizer."""
         raise NotImplementedError
 
-    def handle_message(self, msg):
+    def handle_message(self, msg, source=None):
         """Handle MIDI or control message."""
         self.send(msg.get_bytes())
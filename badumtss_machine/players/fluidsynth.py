@@ -32,23 +32,147 @@ import logging
 import os
 import re
 import signal
+import socket
 
 from .base import Player, PlayerLoadError
+from .. import metrics
 from .. import midi
+from .. import netproto
 
 logger = logging.getLogger("players.fluidsynth")
 fs_logger = logging.getLogger("players.fluidsynth.fluidsynth")
 
-class FluidSynthPlayer(Player):
+# delay before starting a new standby process after the previous one died
+STANDBY_RESPAWN_DELAY = 5.0
+
+# delays between fluidsynth server reconnection attempts
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 10.0
+
+# messages sent through _queue_control()
+CONTROL_MESSAGES = (midi.ControlChange, midi.PitchBend, midi.ChannelPressure)
+
+class FluidSynthShellPlayer(Player):
+    """Base class for players sending commands to the FluidSynth shell.
+
+    Subclasses provide the `_send` method.
+    """
+    def __init__(self, config, section, main_loop):
+        self._encoding = locale.getpreferredencoding(False)
+        self._pending_controls = {}
+        self._control_state = {}
+        self._program_state = {}
+        self._flush_scheduled = False
+        super().__init__(config, section, main_loop)
+        # fluidsynth shell commands executed on start, e.g. 'prog 0 5'
+        self._init_commands = [command.strip() for command
+                               in config[section].get("commands",
+                                                      "").split(";")
+                               if command.strip()]
+        # the shell has no channel pressure command, it is sent as this
+        # controller (modulation wheel by default, which the FluidSynth
+        # default modulators map to vibrato depth, like channel pressure)
+        channel_pressure = config[section].get("channel_pressure", "1")
+        if channel_pressure.strip().lower() in ("", "none"):
+            logger.info("[%s]: channel pressure messages will be dropped",
+                        section)
+            self._pressure_controller = None
+        else:
+            self._pressure_controller = int(channel_pressure)
+
+    def _send(self, command):
+        """Send command to fluidsynth."""
+        raise NotImplementedError
+
+    def _flush_controls(self):
+        """Send the latest values of controllers changed since the last
+        flush."""
+        self._flush_scheduled = False
+        for command in self._pending_controls.values():
+            self._send(command)
+        self._pending_controls.clear()
+
+    def _queue_control(self, key, command):
+        """Queue controller change to be sent at the end of current loop
+        iteration or before the next other message, replacing any pending
+        change of the same controller."""
+        self._pending_controls[key] = command
+        self._control_state[key] = command
+        if not self._flush_scheduled:
+            self.main_loop.call_soon(self._flush_controls)
+            self._flush_scheduled = True
+
+    def _state_commands(self):
+        """Return commands restoring the current controller values and
+        programs (after bank select controllers) on a fresh fluidsynth."""
+        return (list(self._control_state.values())
+                + list(self._program_state.values()))
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message."""
+        if self._pending_controls and not isinstance(msg, CONTROL_MESSAGES):
+            # keep the controller changes before the following notes
+            self._flush_controls()
+        if isinstance(msg, midi.NoteOn):
+            self._send("noteon {} {} {}\n"
+                       .format(msg.channel - 1, msg.note, msg.velocity))
+        elif isinstance(msg, midi.NoteOff):
+            self._send("noteoff {} {} {}\n"
+                       .format(msg.channel - 1, msg.note, msg.velocity))
+        elif isinstance(msg, midi.ControlChange):
+            self._queue_control((msg.channel, msg.controller),
+                                "cc {} {} {}\n".format(msg.channel - 1,
+                                                       msg.controller,
+                                                       msg.value))
+        elif isinstance(msg, midi.PitchBend):
+            self._queue_control((msg.channel, "pitch_bend"),
+                                "pitch_bend {} {}\n".format(msg.channel - 1,
+                                                            msg.value + 8192))
+        elif isinstance(msg, midi.ProgramChange):
+            command = "prog {} {}\n".format(msg.channel - 1, msg.program)
+            self._program_state[msg.channel] = command
+            self._send(command)
+        elif isinstance(msg, midi.ChannelPressure):
+            controller = self._pressure_controller
+            if controller is not None:
+                self._queue_control((msg.channel, controller),
+                                    "cc {} {} {}\n".format(msg.channel - 1,
+                                                           controller,
+                                                           msg.pressure))
+        else:
+            logger.debug("Unsupported message: %r", msg)
+
+class FluidSynthPlayer(FluidSynthShellPlayer):
     """FluidSynt MIDI player.
 
     Sends MIDI notes to a FluidSynth process.
+
+    With the `standby` option set, a second process is kept running with
+    the soundfont loaded and the `commands` executed, and it takes over
+    as soon as the main one dies. Current controller values and programs
+    are replayed to it, all notes are turned off, and a new standby
+    process is started.
     """
     def __init__(self, config, section, main_loop):
-        self._encoding = locale.getpreferredencoding(False)
         self._subprocess = None
         self._supervisor = None
+        self._standby = None
+        self._standby_task = None
+        self._stopping = False
         super().__init__(config, section, main_loop)
+        self._exits_metric = metrics.counter(
+                                    "badumtss_fluidsynth_exits_total",
+                                    "FluidSynth process exits",
+                                    player=section)
+        self._failovers_metric = metrics.counter(
+                                    "badumtss_fluidsynth_failovers_total",
+                                    "Switches to the standby FluidSynth",
+                                    player=section)
+        metrics.gauge("badumtss_fluidsynth_standby_ready",
+                      "Standby FluidSynth process running",
+                      func=lambda: int(self._standby is not None),
+                      player=section)
+        self._use_standby = config[section].getboolean("standby", False)
         self._command = config[section].get("command", "fluidsynth")
         self._audio_driver = config[section].get("audio_driver", None)
         self._extra_options = config[section].get("extra_options", None)
@@ -66,50 +190,126 @@ class FluidSynthPlayer(Player):
         if self._extra_options:
             command += self._extra_options.split(" ")
         command.append(self._soundfont)
-        logger.debug("Starting %r", " ".join(command))
-        create = asyncio.subprocess.create_subprocess_exec(
-                *command,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.DEVNULL,
-                stderr=asyncio.subprocess.PIPE,
-                loop=self.main_loop)
+        self._command_line = command
 
         # start it now, so constructor can fail if there is no fluidsynth
-        task = self.main_loop.create_task(create)
+        task = self.main_loop.create_task(self._spawn())
         self._subprocess = self.main_loop.run_until_complete(task)
 
     def __del__(self):
         if self._subprocess or self._supervisor:
             self.stop()
 
-    async def _supervise(self):
+    async def _spawn(self):
+        """Start a fluidsynth process and pass it the initial commands."""
+        logger.debug("Starting %r", " ".join(self._command_line))
+        process = await asyncio.subprocess.create_subprocess_exec(
+                *self._command_line,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE)
+        for command in self._init_commands:
+            process.stdin.write((command + "\n").encode(self._encoding,
+                                                        "replace"))
+        return process
+
+    async def _supervise(self, process):
         """Process subprocess output and exit status."""
-        if self._subprocess is None:
-            return
         try:
             while True:
-                line = await self._subprocess.stderr.readline()
+                line = await process.stderr.readline()
                 if not line:
                     break
                 fs_logger.debug(line.rstrip().decode(self._encoding, "replace"))
-            rc = await self._subprocess.wait()
+            rc = await process.wait()
+            self._exits_metric.inc()
             if rc > 0:
                 logger.warning("%r exitted with status %r", self._command, rc)
             elif rc < 0 and rc not in (-signal.SIGTERM, -signal.SIGINT):
                 logger.warning("%r killed by signal %r", self._command, -rc)
         finally:
+            self._process_exited(process)
+
+    def _process_exited(self, process):
+        """Handle exit of the main or the standby process."""
+        if self._stopping:
+            return
+        if process is self._subprocess:
             self._subprocess = None
+            if self._use_standby:
+                self._failover()
+        elif process is self._standby:
+            logger.warning("Standby fluidsynth died")
+            self._standby = None
+            self.main_loop.call_later(STANDBY_RESPAWN_DELAY,
+                                      self._start_standby)
+
+    def _failover(self):
+        """Switch to the standby process."""
+        standby = self._standby
+        if standby is None:
+            logger.error("No standby fluidsynth available")
+            self._start_standby()
+            return
+        logger.warning("Switching to the standby fluidsynth")
+        self._failovers_metric.inc()
+        self._standby = None
+        self._subprocess = standby
+        for command in self._state_commands():
+            self._send(command)
+        # notes sounding on the dead process will get their note off
+        # messages sent to this one, make sure none is left hanging
+        for channel in range(16):
+            self._send("cc {} 123 0\n".format(channel))
+        self._start_standby()
+
+    def _start_standby(self):
+        """Start a new standby process in the background."""
+        if self._stopping or self._standby_task is not None:
+            return
+        self._standby_task = self.main_loop.create_task(self._run_standby())
+
+    async def _run_standby(self):
+        try:
+            process = await self._spawn()
+        except OSError as err:
+            logger.error("Cannot start standby fluidsynth: %s", err)
+            self._standby_task = None
+            self.main_loop.call_later(STANDBY_RESPAWN_DELAY,
+                                      self._start_standby)
+            return
+        self._standby_task = None
+        if self._stopping:
+            process.terminate()
+            return
+        self._standby = process
+        if self._subprocess is None:
+            # the main process died while this one was starting
+            self._failover()
+        await self._supervise(process)
 
     def start(self):
         """Start communicating with fluidsynth subprocess."""
-        self._supervisor = self.main_loop.create_task(self._supervise())
+        self._stopping = False
+        if self._subprocess is not None:
+            self._supervisor = self.main_loop.create_task(
+                                        self._supervise(self._subprocess))
+        if self._use_standby:
+            self._start_standby()
 
     def stop(self):
         """Stop fluidsynth."""
+        self._stopping = True
         if self._subprocess:
             self._subprocess.terminate()
+        if self._standby:
+            self._standby.terminate()
+        if self._standby_task:
+            self._standby_task.cancel()
+            self._standby_task = None
         self._supervisor = None
         self._subprocess = None
+        self._standby = None
 
     def _send(self, command):
         """Send command to fluidsynth."""
@@ -118,13 +318,139 @@ class FluidSynthPlayer(Player):
         command = command.encode(self._encoding, "replace")
         self._subprocess.stdin.write(command)
 
-    def handle_message(self, msg):
-        """Handle MIDI or control message."""
-        if isinstance(msg, midi.NoteOn):
-            self._send("noteon {} {} {}\n"
-                       .format(msg.channel - 1, msg.note, msg.velocity))
-        elif isinstance(msg, midi.NoteOff):
-            self._send("noteoff {} {} {}\n"
-                       .format(msg.channel - 1, msg.note, msg.velocity))
+class FluidSynthServerPlayer(FluidSynthShellPlayer):
+    """FluidSynth MIDI player using an already running FluidSynth.
+
+    Connects to the FluidSynth shell server (`fluidsynth -s`) at the
+    `server` address, so the synthesizer with its soundfont loaded
+    outlives badumtss restarts. The connection is re-established when
+    lost, `commands` and the current controller values are sent on each
+    connect. Commands queued in a single loop iteration are written
+    at once.
+    """
+    def __init__(self, config, section, main_loop):
+        self._writer = None
+        self._connection_task = None
+        self._stopping = False
+        self._buffer = []
+        self._write_scheduled = False
+        super().__init__(config, section, main_loop)
+        try:
+            self._family, self._address = netproto.parse_address(
+                                                config[section]["server"])
+        except KeyError:
+            raise PlayerLoadError("[{}]: server address not provided"
+                                  .format(section))
+        except ValueError as err:
+            raise PlayerLoadError("[{}]: {}".format(section, err))
+        self._reconnects_metric = metrics.counter(
+                                    "badumtss_fluidsynth_reconnects_total",
+                                    "FluidSynth server reconnections",
+                                    player=section)
+        metrics.gauge("badumtss_fluidsynth_connected",
+                      "FluidSynth server connection established",
+                      func=lambda: int(self._writer is not None),
+                      player=section)
+
+        # connect now, so constructor can fail if there is no fluidsynth
+        try:
+            task = self.main_loop.create_task(self._connect())
+            self._reader, self._writer = self.main_loop.run_until_complete(task)
+        except OSError as err:
+            raise PlayerLoadError("[{}]: cannot connect to {!r}: {}"
+                                  .format(section, self._address, err))
+
+    def __del__(self):
+        if self._writer or self._connection_task:
+            self.stop()
+
+    async def _connect(self):
+        """Open connection to the fluidsynth server."""
+        logger.debug("Connecting to fluidsynth at %r", self._address)
+        if self._family == socket.AF_UNIX:
+            reader, writer = await asyncio.open_unix_connection(self._address)
         else:
-            logger.debug("Unsupported message: %r", msg)
+            reader, writer = await asyncio.open_connection(*self._address)
+            sock = writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        commands = list(self._init_commands)
+        commands += [command.rstrip("\n")
+                     for command in self._state_commands()]
+        if commands:
+            data = "".join(command + "\n" for command in commands)
+            writer.write(data.encode(self._encoding, "replace"))
+        return reader, writer
+
+    async def _run_connection(self):
+        """Keep the connection up, log fluidsynth output."""
+        delay = RECONNECT_DELAY_MIN
+        while not self._stopping:
+            if self._writer is None:
+                try:
+                    self._reader, self._writer = await self._connect()
+                except OSError as err:
+                    logger.debug("Cannot connect to %r: %s",
+                                 self._address, err)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                    continue
+                logger.info("Reconnected to fluidsynth at %r", self._address)
+                self._reconnects_metric.inc()
+                delay = RECONNECT_DELAY_MIN
+            try:
+                while True:
+                    line = await self._reader.readline()
+                    if not line:
+                        break
+                    line = line.rstrip().decode(self._encoding, "replace")
+                    if line.strip("> "):
+                        fs_logger.debug(line)
+            except OSError as err:
+                logger.debug("Read error: %s", err)
+            if self._stopping:
+                break
+            logger.warning("Connection to fluidsynth at %r lost",
+                           self._address)
+            self._close()
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._reader = None
+        del self._buffer[:]
+
+    def start(self):
+        """Start communicating with the fluidsynth server."""
+        self._stopping = False
+        self._connection_task = self.main_loop.create_task(
+                                                self._run_connection())
+
+    def stop(self):
+        """Disconnect from the fluidsynth server, leaving it running."""
+        self._stopping = True
+        self._write()
+        if self._connection_task:
+            self._connection_task.cancel()
+            self._connection_task = None
+        self._close()
+
+    def _send(self, command):
+        """Queue command to be sent at the end of current loop
+        iteration."""
+        if self._writer is None:
+            return
+        self._buffer.append(command)
+        if not self._write_scheduled:
+            self.main_loop.call_soon(self._write)
+            self._write_scheduled = True
+
+    def _write(self):
+        """Send all queued commands at once."""
+        self._write_scheduled = False
+        if not self._buffer or self._writer is None:
+            return
+        data = "".join(self._buffer).encode(self._encoding, "replace")
+        del self._buffer[:]
+        self._writer.write(data)
@@ -28,31 +28,133 @@
 import logging
 import re
 
+from array import array
 from functools import partial
 from queue import Queue, Empty
+from time import perf_counter, time
+from types import SimpleNamespace
 
 import jack
 
 from .base import RawMidiPlayer, PlayerLoadError
+from .. import metrics
+from .. import midi
+from ..util import parse_integer_list
 
 logger = logging.getLogger("players.jack")
 jack_logger = logging.getLogger("players.jack.jackd")
 
+# number of recent process cycles remembered for XRUN reports
+# (must be a power of two)
+CYCLE_HISTORY = 64
+
+# process callback duration histogram buckets (seconds)
+DURATION_BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+                    0.01, 0.02, 0.05)
+
+# events per process cycle histogram buckets
+EVENTS_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+# how often process statistics are checked (seconds)
+MONITOR_INTERVAL = 1.0
+
+# route table entry for messages other than notes (per channel)
+ROUTE_OTHER = 128
+
+class OutputPort(object):
+    """Jack MIDI output port configuration and routing rule.
+
+    Rule settings are read from `<name>.devices` (input device config
+    sections), `<name>.channels` and `<name>.notes` options of the player
+    section, the connection regex from `<name>.connect`. Missing rule
+    settings match anything.
+    """
+    def __init__(self, name, settings, prefix=""):
+        self.name = name
+        self.port = None
+        connect = settings.get(prefix + "connect", ".*" if not prefix else "")
+        self.connect_re = re.compile(connect) if connect else None
+        devices = settings.get(prefix + "devices")
+        if devices:
+            self.devices = set(item.strip() for item in devices.split(","))
+        else:
+            self.devices = None
+        channels = settings.get(prefix + "channels")
+        if channels:
+            self.channels = set(parse_integer_list(channels))
+        else:
+            self.channels = None
+        notes = settings.get(prefix + "notes")
+        if notes:
+            self.notes = set(parse_integer_list(notes))
+        else:
+            self.notes = None
+
+    def matches(self, source, channel, note=None):
+        """Check if a message should be sent to this port."""
+        if self.devices is not None:
+            if getattr(source, "config_section", None) not in self.devices:
+                return False
+        if self.channels is not None and channel not in self.channels:
+            return False
+        if note is not None and self.notes is not None:
+            return note in self.notes
+        return True
+
 class JackPlayer(RawMidiPlayer):
     """Jack MIDI player.
 
     Sends MIDI notes to a Jack port or ports.
+
+    Additional output ports may be declared with the `ports` option (space
+    separated names), each with its own routing rule (see `OutputPort`).
+    A message goes to the first port its rule matches or to the default
+    `midi_out` port. Note off goes to the port of its note on.
+
+    Events are placed in the Jack period according to their timestamps,
+    delayed by `timing_delay` milliseconds (one period by default), so
+    the timing between them is kept. `timing_delay=0` writes them at the
+    start of the period.
     """
     def __init__(self, config, section, main_loop):
         super().__init__(config, section, main_loop)
-        target_ports_re = config[section].get("connect", ".*")
-        if target_ports_re:
-            self._target_ports_re = re.compile(target_ports_re)
-        else:
-            self._target_ports_re = None
-        start_server = config[section].getboolean("start_server", False)
+        settings = config[section]
+        self._outputs = [OutputPort("midi_out", settings)]
+        for name in settings.get("ports", "").split():
+            self._outputs.append(OutputPort(name, settings, name + "."))
+        # jack port objects, by output index, while active
+        self._ports = []
+        self._port_offsets = array("L")
+        # port index for channel * 129 + note (or ROUTE_OTHER), per input
+        # device config section, for sections not named in port rules
+        self._default_route_table = self._build_route_table(None)
+        self._route_tables = {}
+        for output in self._outputs[1:]:
+            for config_section in output.devices or ():
+                if config_section not in self._route_tables:
+                    self._route_tables[config_section] = \
+                            self._build_route_table(config_section)
+        # port index of the last note on, for channel * 128 + note
+        self._note_ports = bytearray(16 * 128)
+        start_server = settings.getboolean("start_server", False)
         self._active = 0
         self._queue = Queue()
+        self._pending_controls = {}
+        self._xruns_metric = metrics.counter("badumtss_jack_xruns_total",
+                                             "Jack XRUNs")
+        self._events_metric = metrics.counter(
+                                        "badumtss_jack_events_total",
+                                        "MIDI events written to Jack port")
+        metrics.gauge("badumtss_jack_queue_depth",
+                      "MIDI messages waiting for Jack process callback",
+                      func=self._queue.qsize)
+        self._warn_load = config[section].getfloat("warn_load", 0.5)
+        timing_delay = config[section].get("timing_delay", "period")
+        if timing_delay == "period":
+            self._timing_delay = None
+        else:
+            self._timing_delay = float(timing_delay) / 1000.0
+        self._init_process_stats()
         jack.set_error_function(partial(jack_logger.debug, "%s"))
         jack.set_info_function(partial(jack_logger.debug, "%s"))
         try:
@@ -66,34 +168,120 @@ class JackPlayer(RawMidiPlayer):
         self._client.set_port_registration_callback(self._port_registration)
         self._client.set_port_rename_callback(self._port_rename)
         self._client.set_xrun_callback(self._xrun)
+        self._client.set_blocksize_callback(self._blocksize_changed)
+        self._client.set_samplerate_callback(self._samplerate_changed)
         self._client.set_process_callback(self._process)
-        self._port = None
+        self._monitor_handle = None
+        self._blocksize = self._client.blocksize
+        self._samplerate = self._client.samplerate
+        self._update_period()
+
+    def _init_process_stats(self):
+        """Set up process callback statistics.
+
+        Everything updated in the process callback is preallocated here.
+        """
+        self._cycle_durations = array("d", [0.0] * CYCLE_HISTORY)
+        self._cycle_events = array("L", [0] * CYCLE_HISTORY)
+        self._cycle_index = 0
+        self._slow_cycles = 0
+        self._slow_cycles_reported = 0
+        self._slow_max = 0.0
+        self._period = 0.0
+        self._warn_duration = float("inf")
+        self._duration_histogram = metrics.histogram(
+                            "badumtss_jack_process_seconds",
+                            "Jack process callback duration",
+                            DURATION_BUCKETS)
+        self._cycle_events_histogram = metrics.histogram(
+                            "badumtss_jack_process_events",
+                            "MIDI events written per Jack process cycle",
+                            EVENTS_BUCKETS)
+        self._cpu_load_metric = metrics.gauge("badumtss_jack_cpu_load",
+                                              "Jack DSP load (percent)")
+        metrics.gauge("badumtss_jack_period_seconds", "Jack period length",
+                      func=lambda: self._period)
+        metrics.gauge("badumtss_jack_blocksize", "Jack buffer size (frames)",
+                      func=lambda: self._blocksize)
+        metrics.gauge("badumtss_jack_samplerate", "Jack sample rate",
+                      func=lambda: self._samplerate)
+        metrics.counter("badumtss_jack_slow_cycles_total",
+                        "Jack process cycles exceeding warn_load of period",
+                        func=lambda: self._slow_cycles)
+
+    def _update_period(self):
+        if self._samplerate:
+            self._period = self._blocksize / self._samplerate
+            self._warn_duration = self._period * self._warn_load
+        logger.debug("Jack period: %i frames at %i Hz, %.3f ms",
+                     self._blocksize, self._samplerate, self._period * 1000)
+
+    def _blocksize_changed(self, blocksize):
+        """Handle Jack buffer size change."""
+        self._blocksize = blocksize
+        self._update_period()
+
+    def _samplerate_changed(self, samplerate):
+        """Handle Jack sample rate change."""
+        logger.info("Jack sample rate changed to %i", samplerate)
+        self._samplerate = samplerate
+        self._update_period()
+
+    def _monitor(self):
+        """Periodically check process callback statistics."""
+        self._monitor_handle = self.main_loop.call_later(MONITOR_INTERVAL,
+                                                         self._monitor)
+        self._cpu_load_metric.set(self._client.cpu_load())
+        slow_cycles = self._slow_cycles
+        if slow_cycles != self._slow_cycles_reported:
+            logger.warning("%i process cycles took more than %.0f%% of the"
+                           " period (%.3f ms), max: %.3f ms",
+                           slow_cycles - self._slow_cycles_reported,
+                           self._warn_load * 100, self._period * 1000,
+                           self._slow_max * 1000)
+            self._slow_cycles_reported = slow_cycles
+            self._slow_max = 0.0
 
     def start(self):
         """Activate the Jack client and connect to the target ports."""
         if not self._active:
             self._client.activate()
-            self._port = self._client.midi_outports.register("midi_out")
+            for output in self._outputs:
+                output.port = self._client.midi_outports.register(
+                                                                output.name)
+            self._ports = [output.port for output in self._outputs]
+            self._port_offsets = array("L", [0] * len(self._ports))
             self._connect_ports()
+            self._monitor_handle = self.main_loop.call_later(
+                                            MONITOR_INTERVAL, self._monitor)
         self._active += 1
 
     def stop(self):
         """Deactivate the Jack client and disconnect from the server."""
         self._active -= 1
+        if self._monitor_handle is not None:
+            self._monitor_handle.cancel()
+            self._monitor_handle = None
         if self._active < 0:
-            self._port = None
+            self._ports = []
             self._client.deactivate()
             self._client.close()
 
+    def _outputs_for_port(self, port):
+        """Return outputs which should be connected to a Jack port."""
+        if port.name.startswith("Badum-tss machine"):
+            # e.g. the jack_midi input driver port, avoid a feedback loop
+            return []
+        return [output for output in self._outputs
+                if output.port and output.connect_re
+                and output.connect_re.match(port.name)]
+
     def _connect_ports(self):
-        """Connect to available MIDI ports matching configured pattern."""
-        if not self._target_ports_re:
-            return
+        """Connect to available MIDI ports matching configured patterns."""
         for port in self._client.get_ports(is_midi=True, is_input=True):
-            match = self._target_ports_re.match(port.name)
-            if match:
-                logger.info("Connecting to %r", port.name)
-                self._port.connect(port)
+            for output in self._outputs_for_port(port):
+                logger.info("Connecting %r to %r", output.name, port.name)
+                output.port.connect(port)
 
     def _shutdown(self, status, reason):
         """Handle Jack shutdown."""
@@ -107,12 +295,9 @@ class JackPlayer(RawMidiPlayer):
                           port)
         if not port.is_midi or not port.is_input:
             return
-        if not self._target_ports_re or not self._port:
-            return
-        match = self._target_ports_re.match(port.name)
-        if match:
-            logger.info("Connecting to %r", port.name)
-            self.main_loop.call_soon_threadsafe(self._port.connect, port)
+        for output in self._outputs_for_port(port):
+            logger.info("Connecting %r to %r", output.name, port.name)
+            self.main_loop.call_soon_threadsafe(output.port.connect, port)
 
     def _port_rename(self, port, old, new):
         """Handle Jack port rename notification."""
@@ -121,21 +306,136 @@ class JackPlayer(RawMidiPlayer):
 
     def _xrun(self, delay):
         """Handle Jack XRUN notification."""
-        logger.warning("XRUN, delay: %s microseconds", delay)
+        self._xruns_metric.inc()
+        # process cycles preceding the XRUN, oldest first
+        index = self._cycle_index
+        durations = self._cycle_durations.tolist()
+        events = self._cycle_events.tolist()
+        durations = durations[index:] + durations[:index]
+        events = events[index:] + events[:index]
+        recent = ", ".join("{:.3f} ms/{}".format(duration * 1000, count)
+                           for duration, count
+                           in zip(durations[-8:], events[-8:]))
+        logger.warning("XRUN, delay: %s microseconds, max process time: %.3f"
+                       " ms (period: %.3f ms), last cycles: %s",
+                       delay, max(durations) * 1000, self._period * 1000,
+                       recent)
 
     def _process(self, frames):
-        """Pass queued MIDI events to Jack."""
-        if not self._port:
+        """Pass queued MIDI events to Jack.
+
+        Changes of a controller, pitch bend or channel pressure with no
+        other events in between are sent once, with the latest value. The
+        order of the events is kept.
+        """
+        ports = self._ports
+        if not ports:
             return
-        self._port.clear_buffer()
+        start = perf_counter()
+        events = 0
+        for port in ports:
+            port.clear_buffer()
+        samplerate = self._samplerate
+        delay = self._timing_delay
+        if delay is None:
+            delay = self._period
+        if delay:
+            # event timestamp at the period start, with the delay
+            base_time = (time() - delay - self._client.frames_since_cycle_start
+                         / samplerate)
+        last_frame = frames - 1
+        # events must be written in time order, per port
+        offsets = self._port_offsets
+        for i in range(len(offsets)):
+            offsets[i] = 0
+        pending_controls = self._pending_controls
         while True:
             try:
-                msg = self._queue.get(False)
+                port_index, msg, timestamp = self._queue.get(False)
             except Empty:
                 break
-            self._port.write_midi_event(0, msg)
+            status = msg[0] & 0xf0
+            if status == 0xb0:
+                pending_controls[port_index << 16 | msg[0] << 8
+                                 | msg[1]] = port_index, msg
+            elif status == 0xe0 or status == 0xd0:
+                pending_controls[port_index << 16 | msg[0]] = port_index, msg
+            else:
+                if pending_controls:
+                    events += self._write_controls(offsets)
+                offset = offsets[port_index]
+                if delay and timestamp is not None:
+                    frame = int((timestamp - base_time) * samplerate)
+                    if frame > offset:
+                        offset = min(frame, last_frame)
+                        offsets[port_index] = offset
+                ports[port_index].write_midi_event(offset, msg)
+                events += 1
             self._queue.task_done()
+        if pending_controls:
+            events += self._write_controls(offsets)
+        self._events_metric.value += events
+        duration = perf_counter() - start
+        index = self._cycle_index
+        self._cycle_durations[index] = duration
+        self._cycle_events[index] = events
+        self._cycle_index = (index + 1) & (CYCLE_HISTORY - 1)
+        self._duration_histogram.observe(duration)
+        self._cycle_events_histogram.observe(events)
+        if duration > self._warn_duration:
+            self._slow_cycles += 1
+            if duration > self._slow_max:
+                self._slow_max = duration
+
+    def _write_controls(self, offsets):
+        """Write the pending controller changes at the current offsets.
+
+        Return the number of events written."""
+        ports = self._ports
+        pending_controls = self._pending_controls
+        for port_index, msg in pending_controls.values():
+            ports[port_index].write_midi_event(offsets[port_index], msg)
+        count = len(pending_controls)
+        pending_controls.clear()
+        return count
+
+    def _build_route_table(self, config_section):
+        """Compute output port for every channel and note for messages
+        from input devices of `config_section`."""
+        source = SimpleNamespace(config_section=config_section)
+        table = bytearray(16 * 129)
+        for chan_i in range(16):
+            for note in range(129):
+                for index, output in enumerate(self._outputs[1:], 1):
+                    if note == ROUTE_OTHER:
+                        match = output.matches(source, chan_i + 1)
+                    else:
+                        match = output.matches(source, chan_i + 1, note)
+                    if match:
+                        table[chan_i * 129 + note] = index
+                        break
+        return table
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message."""
+        if len(self._outputs) == 1:
+            self._queue.put((0, msg.get_bytes(), msg.timestamp))
+            return
+        table = self._route_tables.get(getattr(source, "config_section", None),
+                                       self._default_route_table)
+        chan_i = (msg.channel - 1) & 0x0f
+        msg_type = type(msg)
+        if msg_type is midi.NoteOn or msg_type is midi.NoteOff:
+            note_key = chan_i << 7 | (msg.note & 0x7f)
+            if msg_type is midi.NoteOn and msg.velocity:
+                port_index = table[chan_i * 129 + (msg.note & 0x7f)]
+                self._note_ports[note_key] = port_index
+            else:
+                port_index = self._note_ports[note_key]
+        else:
+            port_index = table[chan_i * 129 + ROUTE_OTHER]
+        self._queue.put((port_index, msg.get_bytes(), msg.timestamp))
 
     def send(self, midi_bytes):
         """Send a MIDI message to the synthesizer."""
-        self._queue.put(midi_bytes)
+        self._queue.put((0, midi_bytes, None))
@@ -0,0 +1,227 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Record MIDI messages to Standard MIDI Files."""
+
+import logging
+import os
+import struct
+import threading
+import time
+
+from collections import deque
+
+from .base import Player, PlayerLoadError
+from .. import metrics
+
+logger = logging.getLogger("players.recorder")
+
+# 1000 ticks per quarter note at 60 BPM – one tick per millisecond
+DIVISION = 1000
+TEMPO = 1000000
+TICKS_PER_SECOND = 1000
+
+HEADER_CHUNK = struct.pack(">4sIHHH", b"MThd", 6, 0, 1, DIVISION)
+TRACK_LENGTH_OFFSET = len(HEADER_CHUNK) + 4
+TRACK_START = (b"MTrk" + b"\0\0\0\0"
+               + b"\x00\xff\x51\x03" + TEMPO.to_bytes(3, "big"))
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+def encode_vlq(value):
+    """Encode a MIDI file variable length quantity."""
+    result = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7f))
+        value >>= 7
+    result.reverse()
+    return result
+
+class MidiFileWriter(object):
+    """Standard MIDI File (format 0) being written."""
+    def __init__(self, path, start_time):
+        self.path = path
+        self.start_time = start_time
+        self._last_tick = 0
+        self._file = open(path, "wb")
+        self._file.write(HEADER_CHUNK)
+        self._file.write(TRACK_START)
+        self.size = len(HEADER_CHUNK) + len(TRACK_START)
+
+    def encode_events(self, events):
+        """Encode (timestamp, midi_bytes) pairs as track data."""
+        data = bytearray()
+        last_tick = self._last_tick
+        start_time = self.start_time
+        for timestamp, midi_bytes in events:
+            tick = int((timestamp - start_time) * TICKS_PER_SECOND)
+            if tick < last_tick:
+                # out of order timestamps
+                tick = last_tick
+            data += encode_vlq(tick - last_tick)
+            data += midi_bytes
+            last_tick = tick
+        self._last_tick = last_tick
+        return data
+
+    def write(self, data):
+        """Write encoded track data."""
+        self._file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Finish the track and fix its length in the track header."""
+        self._file.write(END_OF_TRACK)
+        self.size += len(END_OF_TRACK)
+        track_length = self.size - TRACK_LENGTH_OFFSET - 4
+        self._file.seek(TRACK_LENGTH_OFFSET)
+        self._file.write(struct.pack(">I", track_length))
+        self._file.close()
+
+class RecorderPlayer(Player):
+    """MIDI recorder.
+
+    Saves received MIDI messages to Standard MIDI Files. The messages are
+    only queued by `handle_message`, encoding and writing is done by
+    a background thread.
+    """
+    def __init__(self, config, section, main_loop):
+        super().__init__(config, section, main_loop)
+        self._directory = os.path.expanduser(
+                                config[section].get("directory", "."))
+        self._filename = config[section].get("filename",
+                                             "badumtss-%Y%m%d-%H%M%S.mid")
+        self._max_size = config[section].getint("max_size", 0)
+        self._max_time = config[section].getfloat("max_time", 0)
+        self._flush_interval = config[section].getfloat("flush_interval",
+                                                        1.0)
+        if not os.path.isdir(self._directory):
+            raise PlayerLoadError("[{}]: {!r} is not a directory"
+                                  .format(section, self._directory))
+        self._events = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._failed = False
+        metrics.gauge("badumtss_recorder_queue_depth",
+                      "MIDI messages waiting to be written",
+                      func=lambda: len(self._events), player=section)
+        metrics.gauge("badumtss_recorder_failed",
+                      "1 if recording failed",
+                      func=lambda: int(self._failed), player=section)
+
+    def start(self):
+        """Start the writer thread."""
+        if self._thread:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._writer_thread,
+                                        name="MIDI recorder",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write pending events and close the file."""
+        if not self._thread:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message."""
+        if self._failed:
+            return
+        timestamp = msg.timestamp
+        if timestamp is None:
+            timestamp = time.time()
+        self._events.append((timestamp, msg.get_bytes()))
+
+    def _open_file(self, start_time):
+        """Open new MIDI file for recording."""
+        filename = time.strftime(self._filename, time.localtime(start_time))
+        path = os.path.join(self._directory, filename)
+        base, ext = os.path.splitext(path)
+        i = 1
+        while os.path.exists(path):
+            path = "{}-{}{}".format(base, i, ext)
+            i += 1
+        logger.info("Recording to %r", path)
+        return MidiFileWriter(path, start_time)
+
+    def _drain(self):
+        """Get events queued so far."""
+        events = []
+        events_append = events.append
+        popleft = self._events.popleft
+        while True:
+            try:
+                events_append(popleft())
+            except IndexError:
+                break
+        return events
+
+    def _writer_thread(self):
+        """Encode and write events queued by `handle_message`."""
+        writer = None
+        try:
+            while True:
+                self._wakeup.wait(self._flush_interval)
+                self._wakeup.clear()
+                running = self._running
+                events = self._drain()
+                if events:
+                    if writer and self._need_rotation(writer, events[0][0]):
+                        writer.close()
+                        writer = None
+                    if not writer:
+                        writer = self._open_file(events[0][0])
+                    writer.write(writer.encode_events(events))
+                    writer.flush()
+                if not running:
+                    break
+        except OSError as err:
+            logger.error("Recording failed: %s", err)
+            self._failed = True
+            self._events.clear()
+        finally:
+            if writer:
+                try:
+                    writer.close()
+                except OSError as err:
+                    logger.error("Could not finish %r: %s", writer.path, err)
+
+    def _need_rotation(self, writer, timestamp):
+        """Check if the current file is complete."""
+        if self._max_size and writer.size >= self._max_size:
+            return True
+        if self._max_time and timestamp - writer.start_time >= self._max_time:
+            return True
+        return False
@@ -0,0 +1,165 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Send MIDI messages over the network."""
+
+import logging
+import socket
+import time
+
+from array import array
+
+from .base import Player, PlayerLoadError
+from .. import metrics
+from .. import netproto
+
+logger = logging.getLogger("players.udp")
+
+class UdpPlayer(Player):
+    """Network MIDI player.
+
+    Sends MIDI messages in UDP (or Unix) datagrams, as described in the
+    `netproto` module. All messages passed during a single event loop
+    iteration are sent in one packet.
+    """
+    def __init__(self, config, section, main_loop):
+        super().__init__(config, section, main_loop)
+        try:
+            family, self._address = netproto.parse_address(
+                                                config[section]["address"])
+        except KeyError:
+            raise PlayerLoadError("[{}]: address not provided"
+                                  .format(section))
+        except ValueError as err:
+            raise PlayerLoadError("[{}]: {}".format(section, err))
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._buffer = bytearray(netproto.MAX_PACKET_SIZE)
+        self._view = memoryview(self._buffer)
+        self._timestamps = array("d", [0.0] * netproto.MAX_RECORDS)
+        self._count = 0
+        # oldest timestamp of the queued messages
+        self._min_timestamp = 0.0
+        self._seq = 0
+        self._flush_scheduled = False
+        self.packets_sent = 0
+        self.messages_sent = 0
+        self.packets_dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        labels = {"player": section}
+        metrics.counter("badumtss_udp_packets_total", "UDP packets sent",
+                        func=lambda: self.packets_sent, **labels)
+        metrics.counter("badumtss_udp_messages_total", "UDP messages sent",
+                        func=lambda: self.messages_sent, **labels)
+        metrics.counter("badumtss_udp_packets_dropped_total",
+                        "UDP packets that could not be sent",
+                        func=lambda: self.packets_dropped, **labels)
+        metrics.gauge("badumtss_udp_latency_max_seconds",
+                      "Maximum capture to send latency",
+                      func=lambda: self.latency_max, **labels)
+
+    def start(self):
+        """Connect the socket to the receiver."""
+        try:
+            self._socket.connect(self._address)
+        except OSError as err:
+            logger.error("Cannot connect to %r: %s", self._address, err)
+
+    def stop(self):
+        """Send pending messages and close the socket."""
+        if self._socket is None:
+            return
+        self._flush()
+        if self.packets_sent:
+            logger.info("%i messages sent in %i packets, %i packets dropped,"
+                        " latency: %.3f ms average, %.3f ms max",
+                        self.messages_sent, self.packets_sent,
+                        self.packets_dropped,
+                        self.latency_total * 1000 / self.packets_sent,
+                        self.latency_max * 1000)
+        self._socket.close()
+        self._socket = None
+
+    def handle_message(self, msg, source=None):
+        """Handle MIDI or control message."""
+        count = self._count
+        if count >= netproto.MAX_RECORDS:
+            self._flush()
+            count = 0
+        midi_bytes = msg.get_bytes()
+        timestamp = msg.timestamp
+        if timestamp is None:
+            timestamp = time.time()
+        netproto.MIDI_RECORD.pack_into(self._buffer,
+                                       netproto.HEADER.size
+                                       + count * netproto.RECORD_SIZE,
+                                       0, len(midi_bytes), midi_bytes)
+        self._timestamps[count] = timestamp
+        if not count or timestamp < self._min_timestamp:
+            self._min_timestamp = timestamp
+        self._count = count + 1
+        if not self._flush_scheduled:
+            self.main_loop.call_soon(self._flush)
+            self._flush_scheduled = True
+
+    def _flush(self):
+        """Send queued messages in a single datagram."""
+        self._flush_scheduled = False
+        count = self._count
+        if not count or self._socket is None:
+            return
+        self._count = 0
+        buf = self._buffer
+        timestamps = self._timestamps
+        now = time.time()
+        for i in range(count):
+            offset = int((timestamps[i] - now) * 1000000)
+            if offset < -0x80000000:
+                offset = -0x80000000
+            elif offset > 0x7fffffff:
+                offset = 0x7fffffff
+            netproto.OFFSET.pack_into(buf,
+                                      netproto.HEADER.size
+                                      + i * netproto.RECORD_SIZE,
+                                      offset)
+        netproto.HEADER.pack_into(buf, 0, netproto.MAGIC, netproto.VERSION,
+                                  netproto.RECORD_MIDI, count, self._seq, now)
+        self._seq = (self._seq + 1) & 0xffffffff
+        size = netproto.HEADER.size + count * netproto.RECORD_SIZE
+        try:
+            self._socket.send(self._view[:size])
+        except OSError as err:
+            # includes BlockingIOError when the socket buffer is full
+            self.packets_dropped += 1
+            logger.debug("Packet dropped: %s", err)
+            return
+        latency = time.time() - self._min_timestamp
+        self.packets_sent += 1
+        self.messages_sent += count
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
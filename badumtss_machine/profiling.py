@@ -0,0 +1,219 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Session profiling.
+
+Two profilers are available: the sampling one, which periodically
+captures stacks of all threads from a separate thread and writes them in
+the 'collapsed stack' format accepted by flamegraph tools, and the
+deterministic one, based on `cProfile`, writing a `pstats` file.
+
+Either way a summary of time spent in each subsystem is logged on exit.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+
+logger = logging.getLogger("profiling")
+
+PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_DIR = os.path.join(PKG_DIR, "input") + os.sep
+PLAYERS_DIR = os.path.join(PKG_DIR, "players") + os.sep
+
+TRANSLATE_FUNCTIONS = {"translate", "interpret_event", "get_velocity",
+                       "get_note", "get_timestamp", "compile_note_table"}
+
+# innermost functions of threads waiting for something to do
+IDLE_FUNCTIONS = {"select", "poll", "wait", "run", "run_forever"}
+IDLE_MODULES = ("selectors.py", "threading.py", "glib_events.py")
+
+DEFAULT_OUTPUT = {
+        "sampling": "badumtss-profile.folded",
+        "cprofile": "badumtss-profile.pstats",
+        }
+
+def frame_subsystem(filename, function):
+    """Return subsystem name for code in `filename` and `function` or None.
+    """
+    if filename.startswith(INPUT_DIR):
+        if filename.endswith("gtk.py") and function.startswith("_draw"):
+            return "gtk drawing"
+        if function in TRANSLATE_FUNCTIONS:
+            return "translate"
+        return "input driver"
+    if filename.startswith(PLAYERS_DIR):
+        return "player"
+    if filename.startswith(PKG_DIR):
+        basename = os.path.basename(filename)
+        if basename in ("notestate.py", "scheduler.py"):
+            return "player"
+        if basename == "main.py" and function in ("route_messages",
+                                                 "route"):
+            return "router"
+        if basename in ("logutil.py", "metrics.py"):
+            return "logging/metrics"
+    elif os.sep + "logging" + os.sep in filename:
+        return "logging/metrics"
+    return None
+
+def stack_subsystem(codes):
+    """Return subsystem of a stack given as code objects, innermost first.
+
+    The innermost frame belonging to a known subsystem decides.
+    """
+    if not codes:
+        return "other"
+    innermost = codes[0]
+    if (innermost.co_name in IDLE_FUNCTIONS
+            and innermost.co_filename.endswith(IDLE_MODULES)):
+        return "idle"
+    for code in codes:
+        subsystem = frame_subsystem(code.co_filename, code.co_name)
+        if subsystem:
+            return subsystem
+    return "other"
+
+def _code_label(code):
+    """Return flamegraph frame label for a code object."""
+    path = code.co_filename.split(os.sep)
+    return "{} ({}:{})".format(code.co_name, "/".join(path[-2:]),
+                               code.co_firstlineno)
+
+def _format_summary(counts):
+    total = sum(counts.values())
+    if not total:
+        return "no data"
+    return ", ".join("{} {:.1f}%".format(subsystem, 100.0 * count / total)
+                     for subsystem, count in counts.most_common())
+
+class SamplingProfiler(object):
+    """Profiler periodically sampling stacks of all threads.
+
+    The sampling thread only records code objects of the stack frames,
+    everything else is done when the results are written.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._samples = Counter()
+        self._thread_names = {}
+        self._n_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling."""
+        self._thread = threading.Thread(target=self._run, name="profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        samples = self._samples
+        thread_names = self._thread_names
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if ident not in thread_names:
+                    for thread in threading.enumerate():
+                        thread_names[thread.ident] = thread.name
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                samples[ident, tuple(codes)] += 1
+            self._n_samples += 1
+
+    def stop(self, filename):
+        """Stop sampling, write collapsed stacks to `filename` and log
+        the summary."""
+        self._stop.set()
+        self._thread.join()
+        by_thread = {}
+        labels = {}
+        with open(filename, "w") as output:
+            for (ident, codes), count in self._samples.items():
+                thread_name = self._thread_names.get(ident, str(ident))
+                counts = by_thread.setdefault(thread_name, Counter())
+                counts[stack_subsystem(codes)] += count
+                frames = [thread_name]
+                for code in reversed(codes):
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _code_label(code)
+                    frames.append(label)
+                output.write("{} {}\n".format(";".join(frames), count))
+        logger.info("Profile: %i samples every %.1f ms written to %r",
+                    self._n_samples, self.interval * 1000, filename)
+        for thread_name, counts in sorted(by_thread.items()):
+            logger.info("  %s: %s", thread_name, _format_summary(counts))
+
+class DeterministicProfiler(object):
+    """cProfile based profiler of the main thread."""
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._start_time = None
+
+    def start(self):
+        """Start profiling."""
+        self._start_time = time.perf_counter()
+        self._profile.enable()
+
+    def stop(self, filename):
+        """Stop profiling, write pstats to `filename` and log the summary.
+        """
+        self._profile.disable()
+        duration = time.perf_counter() - self._start_time
+        self._profile.dump_stats(filename)
+        stats = pstats.Stats(self._profile).stats
+        counts = Counter()
+        for (func_file, line, function), stat in stats.items():
+            total_time = stat[2]
+            if func_file == "~" and ("poll" in function
+                                     or "select" in function):
+                subsystem = "idle"
+            else:
+                subsystem = frame_subsystem(func_file, function) or "other"
+            counts[subsystem] += total_time
+        logger.info("Profile: %.1f s of the main thread written to %r",
+                    duration, filename)
+        logger.info("  MainThread: %s", _format_summary(counts))
+
+def start_profiler(mode, interval=0.005):
+    """Create and start a profiler for given `mode` ('sampling' or
+    'cprofile')."""
+    if mode == "cprofile":
+        profiler = DeterministicProfiler()
+    else:
+        profiler = SamplingProfiler(interval)
+    profiler.start()
+    return profiler
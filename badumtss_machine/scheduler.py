@@ -0,0 +1,200 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Delayed events scheduling."""
+
+import logging
+import math
+
+logger = logging.getLogger("scheduler")
+
+# timer wheel tick length in seconds
+RESOLUTION = 0.002
+
+# number of timer wheel slots, one wheel rotation is RESOLUTION * SLOTS
+SLOTS = 512
+
+class Timer(object):
+    """Scheduled call, returned by `TimerWheel.call_at`."""
+    __slots__ = ("_wheel", "tick", "callback", "args", "cancelled", "done")
+    def __init__(self, wheel, tick, callback, args):
+        self._wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.done = False
+
+    @property
+    def when(self):
+        """Scheduled call time (in `TimerWheel.time()` units)."""
+        return self.tick * self._wheel.resolution
+
+    def cancel(self):
+        """Cancel the call.
+
+        The timer is only marked as cancelled here, it is dropped from the
+        wheel when its slot is processed."""
+        if self.cancelled or self.done:
+            return
+        self.cancelled = True
+        self._wheel._timer_cancelled()
+
+class TimerWheel(object):
+    """Hashed timer wheel running on the asyncio loop clock.
+
+    Timers are appended to the slot of their expiry tick (modulo the
+    number of slots) and cancelled by marking, so both scheduling and
+    cancelling are O(1). The loop is woken up only at the ticks of
+    the pending timers, by a single loop callback.
+    """
+    def __init__(self, loop, resolution=RESOLUTION, slots=SLOTS):
+        self.loop = loop
+        self.resolution = resolution
+        self._slots = [[] for i in range(slots)]
+        self._last_tick = 0
+        self._pending = 0
+        self._handle = None
+        self._handle_tick = None
+
+    @property
+    def pending(self):
+        """Number of timers pending."""
+        return self._pending
+
+    def time(self):
+        """Return current scheduler time."""
+        return self.loop.time()
+
+    def call_at(self, when, callback, *args):
+        """Schedule `callback(*args)` call at `when` (in `time()` units).
+
+        Return a Timer object."""
+        if not self._pending:
+            self._last_tick = int(self.loop.time() / self.resolution)
+        tick = int(math.ceil(when / self.resolution))
+        if tick <= self._last_tick:
+            tick = self._last_tick + 1
+        timer = Timer(self, tick, callback, args)
+        self._slots[tick % len(self._slots)].append(timer)
+        self._pending += 1
+        if self._handle is None or tick < self._handle_tick:
+            self._schedule(tick)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Schedule `callback(*args)` call after `delay` seconds.
+
+        Return a Timer object."""
+        return self.call_at(self.loop.time() + delay, callback, *args)
+
+    def _schedule(self, tick):
+        """Set the loop wakeup to `tick`, replacing the current one."""
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self.loop.call_at(tick * self.resolution, self._run)
+        self._handle_tick = tick
+
+    def _timer_cancelled(self):
+        self._pending -= 1
+        if not self._pending and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _next_tick(self):
+        """Return the earliest tick of a pending timer or None."""
+        slots = self._slots
+        n_slots = len(slots)
+        last_tick = self._last_tick
+        nearest = None
+        for i in range(1, n_slots + 1):
+            tick = last_tick + i
+            for timer in slots[tick % n_slots]:
+                if timer.cancelled:
+                    continue
+                if timer.tick <= tick:
+                    # nothing earlier in the following slots
+                    return timer.tick
+                if nearest is None or timer.tick < nearest:
+                    nearest = timer.tick
+        return nearest
+
+    def _run(self):
+        """Process all the ticks passed since the last run."""
+        self._handle = None
+        now_tick = int(self.loop.time() / self.resolution)
+        slots = self._slots
+        n_slots = len(slots)
+        last_tick = self._last_tick
+        due = []
+        for i in range(1, min(now_tick - last_tick, n_slots) + 1):
+            slot_i = (last_tick + i) % n_slots
+            slot = slots[slot_i]
+            if not slot:
+                continue
+            keep = []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                elif timer.tick <= now_tick:
+                    due.append(timer)
+                else:
+                    keep.append(timer)
+            slots[slot_i] = keep
+        due.sort(key=lambda timer: timer.tick)
+        # timers added by the callbacks go after now_tick
+        self._last_tick = max(now_tick, last_tick)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            self._pending -= 1
+            timer.done = True
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Exception in scheduled call %r",
+                                 timer.callback)
+        if self._pending:
+            tick = self._next_tick()
+            if tick is not None and (self._handle is None
+                                     or tick < self._handle_tick):
+                self._schedule(tick)
+
+class Scheduler(TimerWheel):
+    """Timer wheel delivering delayed messages to a player.
+
+    `sink` is called as `sink(msg, source)`, like
+    `NoteStateTracker.handle_message`.
+    """
+    def __init__(self, loop, sink, resolution=RESOLUTION, slots=SLOTS):
+        super().__init__(loop, resolution, slots)
+        self.sink = sink
+
+    def send_later(self, delay, msg, source=None):
+        """Pass `msg` to the sink after `delay` seconds.
+
+        Return a Timer object."""
+        return self.call_later(delay, self.sink, msg, source)
@@ -0,0 +1,81 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Miscellaneous helpers."""
+
+import logging
+import os
+import socket
+
+from .netproto import parse_address
+
+logger = logging.getLogger("util")
+
+def parse_integer_list(items):
+    """Yield values from a list of integer and integer ranges."""
+    for item in items.split(","):
+        if "-" in item:
+            low, high = item.split("-", 1)
+            try:
+                low = int(low)
+                high = int(high)
+            except ValueError:
+                logger.warning("Invalid range in list: %r in %r",
+                               item, items)
+                continue
+            yield from range(low, high+1)
+        else:
+            try:
+                yield int(item)
+            except ValueError:
+                logger.warning("Invalid integer in list: %r in %r",
+                               item, items)
+                continue
+
+def start_stream_server(loop, factory, listen, section):
+    """Start a stream server with `factory` protocol on the `listen`
+    address (`unix:PATH`, `HOST:PORT` or `[HOST]:PORT`).
+
+    A stale Unix socket is removed first. Errors are logged for the
+    config `section`.
+
+    Return the asyncio Server object or None.
+    """
+    try:
+        family, address = parse_address(listen)
+    except ValueError as err:
+        logger.error("[%s]: %s", section, err)
+        return None
+    try:
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            create = loop.create_unix_server(factory, address)
+        else:
+            create = loop.create_server(factory, *address)
+        return loop.run_until_complete(create)
+    except OSError as err:
+        logger.error("[%s]: cannot listen on %r: %s", section, address, err)
+        return None
@@ -0,0 +1,195 @@
+# Copyright (c) 2016, Jacek Konieczny
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Event loop lag monitoring.
+
+A heartbeat callback scheduled on the loop every `interval` measures how
+late it is run (the loop lag). A separate thread checks that the
+heartbeat keeps running and, when the loop is blocked for longer than
+`threshold`, logs the stack of the main thread and the input device and
+player it was busy with (marked by the message routing code).
+
+Configured in the optional `[watchdog]` section.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+
+logger = logging.getLogger("watchdog")
+
+LAG_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2,
+               0.5, 1.0)
+
+# number of innermost stack frames logged
+STACK_DEPTH = 12
+
+# input device and player the loop thread is currently passing events
+# to, set (and cleared afterwards) by the message routing code. Plain
+# attribute writes, so cheap enough for every message, and read by the
+# watchdog thread without touching the frames of the loop thread.
+busy_device = None
+busy_player = None
+
+# source directories of the input drivers and players
+_PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIRS = {
+        os.path.join(_PKG_DIR, "input"): "input device",
+        os.path.join(_PKG_DIR, "players"): "player",
+        }
+
+def describe_culprit(frame):
+    """Describe the input device and player the loop is busy with and
+    the innermost input device or player code on the stack.
+
+    Only the `busy_device` and `busy_player` markers, code objects and
+    line numbers are used, as the frames belong to another thread.
+
+    Return description string or None.
+    """
+    parts = []
+    device = busy_device
+    if device is not None:
+        parts.append("input device {!r}".format(device.name))
+    player = busy_player
+    if player is not None:
+        parts.append("player {}".format(type(player).__name__))
+    while frame is not None:
+        code = frame.f_code
+        kind = CODE_DIRS.get(os.path.dirname(code.co_filename))
+        if kind is not None:
+            parts.append("{} code {} ({}:{})".format(
+                            kind, getattr(code, "co_qualname", code.co_name),
+                            os.path.basename(code.co_filename),
+                            frame.f_lineno))
+            break
+        frame = frame.f_back
+    if not parts:
+        return None
+    return ", ".join(parts)
+
+class LoopWatchdog(object):
+    """Measure event loop lag and report the loop being blocked."""
+    def __init__(self, loop, interval=0.01, threshold=0.05):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self._main_ident = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._reported_beat = None
+        self._paused = True
+        self._expected = None
+        self._handle = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lag_histogram = metrics.histogram(
+                                    "badumtss_loop_lag_seconds",
+                                    "Event loop heartbeat lag",
+                                    LAG_BUCKETS)
+        self._stalls_metric = metrics.counter(
+                                    "badumtss_loop_stalls_total",
+                                    "Event loop blocked longer than"
+                                    " the watchdog threshold")
+
+    def start(self):
+        """Start the heartbeat and the watchdog thread."""
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._heartbeat)
+        self._thread = threading.Thread(target=self._watch, name="watchdog",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring."""
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _heartbeat(self):
+        now = self.loop.time()
+        if self._paused:
+            # the loop has not been running, the lag is meaningless
+            self._paused = False
+        else:
+            lag = now - self._expected
+            self._lag_histogram.observe(lag)
+            if self._reported_beat == self._last_beat:
+                logger.warning("Event loop was blocked for %.1f ms",
+                               (lag + self.interval) * 1000)
+        self._last_beat = time.monotonic()
+        self._expected = now + self.interval
+        self._handle = self.loop.call_at(self._expected, self._heartbeat)
+
+    def _watch(self):
+        """Watchdog thread main loop."""
+        while not self._stop.wait(self.threshold / 2):
+            if not self.loop.is_running():
+                self._paused = True
+                continue
+            last_beat = self._last_beat
+            blocked = time.monotonic() - last_beat - self.interval
+            if blocked > self.threshold and last_beat != self._reported_beat:
+                self._reported_beat = last_beat
+                self._report(blocked)
+
+    def _report(self, blocked):
+        """Log what the main thread is doing."""
+        self._stalls_metric.inc()
+        frame = sys._current_frames().get(self._main_ident)
+        if frame is None:
+            return
+        culprit = describe_culprit(frame)
+        stack = traceback.format_stack(frame)[-STACK_DEPTH:]
+        logger.warning("Event loop blocked for over %.0f ms%s, at:\n%s",
+                       blocked * 1000,
+                       " in " + culprit if culprit else "",
+                       "".join(stack).rstrip())
+
+def start_watchdog(config, loop):
+    """Start loop watchdog unless disabled in the `[watchdog]` section.
+
+    Return the LoopWatchdog object or None.
+    """
+    if "watchdog" in config:
+        section = config["watchdog"]
+        if section.getboolean("disabled", False):
+            return None
+        interval = section.getfloat("interval", 10) / 1000.0
+        threshold = section.getfloat("threshold", 50) / 1000.0
+    else:
+        interval = 0.01
+        threshold = 0.05
+    watchdog = LoopWatchdog(loop, interval, threshold)
+    watchdog.start()
+    return watchdog
@@ -32,7 +32,9 @@ import os
 from collections import defaultdict
 from configparser import ConfigParser, ExtendedInterpolation
 
+from .calibration import analyze_hits
 from .input import input_devices_generator
+from .util import parse_integer_list
 from . import midi
 
 logger = logging.getLogger("wizard")
@@ -40,6 +42,9 @@ logger = logging.getLogger("wizard")
 PKG_DIR = os.path.dirname(os.path.abspath(__file__))
 PRESETS_CONFIG = os.path.join(PKG_DIR, "presets.conf")
 
+# axis calibration recording time in seconds
+CALIBRATION_TIME = 8.0
+
 class LineInput:
     def __init__(self, loop):
         self.loop = loop
@@ -70,27 +75,6 @@ class LineInput:
             return None
         return line.decode('utf8').strip()
 
-def parse_integer_list(items):
-    """Yield values from a list of integer and integer ranges."""
-    for item in items.split(","):
-        if "-" in item:
-            low, high = item.split("-", 1)
-            try:
-                low = int(low)
-                high = int(high)
-            except ValueError:
-                logger.warning("Invalid range in list: %r in %r",
-                               item, items)
-                continue
-            yield from range(low, high+1)
-        else:
-            try:
-                yield int(item)
-            except ValueError:
-                logger.warning("Invalid integer in list: %r in %r",
-                               item, items)
-                continue
-
 class Preset:
     def __init__(self, config, section):
         self.notemap = {}
@@ -340,6 +324,44 @@ class KeymapWizard:
                 self.play_note(note)
             finally:
                 self.line_input.resume()
+            if key_name.startswith("ABS_"):
+                await self.calibrate_axis(key_name)
+
+    async def calibrate_axis(self, key_name):
+        """Record hits on an axis and fit its thresholds and velocity
+        coefficient."""
+        if not hasattr(self.input_device, "record_axis"):
+            return
+        axis_range = self.input_device.get_axis_range(key_name)
+        if axis_range is None:
+            return
+        answer = await self.ask("Calibrate {}? [Y/n] > ".format(key_name))
+        if answer and answer.lower() not in ("y", "yes"):
+            return
+        print("Hit it a few times, from the softest to the hardest,"
+              " for {:.0f} seconds...".format(CALIBRATION_TIME))
+        self.line_input.pause()
+        try:
+            samples = await self.input_device.record_axis(key_name,
+                                                          CALIBRATION_TIME)
+        finally:
+            self.line_input.resume()
+        result = analyze_hits(samples, *axis_range)
+        if result is None:
+            print("No hits recorded, keeping the current settings.")
+            return
+        print("{} hits, noise up to {:.1f}%, peaks {:.1f}%-{:.1f}%"
+              .format(result.hits, result.noise,
+                      min(result.peaks), max(result.peaks)))
+        settings = self.keymap[key_name]
+        settings["thres_low"] = "{:.1f}%".format(result.thres_low)
+        settings["thres_high"] = "{:.1f}%".format(result.thres_high)
+        if result.velocity_coeff is not None:
+            settings["velocity_coeff"] = "{:.3g}".format(result.velocity_coeff)
+        for setting in ("thres_low", "thres_high", "velocity_coeff"):
+            if setting in settings:
+                print(" {}={}".format(setting, settings[setting]))
+        self.saved = False
 
     def _get_bindings(self):
         """Get list of current bindings."""
@@ -413,6 +435,8 @@ class KeymapWizard:
         if key_name not in self.keymap:
             self.keymap.add_section(key_name)
         self.keymap[key_name]["note"] = str(note)
+        if key_name.startswith("ABS_"):
+            await self.calibrate_axis(key_name)
         defaults = self.keymap["defaults"]
         for setting in ("channel", "velocity"):
             value = self.preset.settings.get(setting)
@@ -0,0 +1,130 @@
+"""EventDevice event decoding and delivery tests (see
+tools/bench_evdev_read.py for the benchmark)."""
+
+import os
+import unittest
+
+try:
+    from badumtss_machine.input.evdev import EventDevice, INPUT_EVENT
+    from badumtss_machine.input.evdev import READ_EVENTS, RawEvent
+    from badumtss_machine.input.evdev import AbsEventHandler
+    from evdev import AbsInfo
+except ImportError:
+    EventDevice = None
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+class Handler(object):
+    def __init__(self, name, switch_to=None):
+        self.name = name
+        self.switch_to = switch_to
+        self.device = None
+
+    def translate(self, event):
+        if self.switch_to is not None:
+            self.device._event_map = self.switch_to
+        return (self.name, event.type, event.code, event.value,
+                event.timestamp())
+
+@unittest.skipIf(EventDevice is None, "python-evdev not available")
+class ReadEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        device = EventDevice.__new__(EventDevice)
+        device.device = type("Device", (), {"fd": self.read_fd})()
+        device._buffer = bytearray(INPUT_EVENT.size * READ_EVENTS)
+        device._view = memoryview(device._buffer)
+        device.events_metric = Counter()
+        device._event_map = {}
+        self.device = device
+        self.messages = []
+
+    def tearDown(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def write(self, events):
+        os.write(self.write_fd, b"".join(INPUT_EVENT.pack(*event)
+                                         for event in events))
+
+    def read(self):
+        self.device.read_events(self.messages.append)
+
+    def test_mapped_events_only(self):
+        self.device._event_map = {(1, 304): Handler("a")}
+        self.write([(10, 500000, 3, 0, 120),
+                    (10, 500000, 1, 304, 1),
+                    (10, 500000, 0, 0, 0),
+                    (11, 250000, 1, 304, 0)])
+        self.read()
+        self.assertEqual(self.messages, [("a", 1, 304, 1, 10.5),
+                                         ("a", 1, 304, 0, 11.25)])
+        self.assertEqual(self.device.events_metric.value, 4)
+
+    def test_more_than_buffer(self):
+        self.device._event_map = {(1, 304): Handler("a")}
+        count = READ_EVENTS * 2 + 5
+        self.write([(1, 0, 1, 304, i & 1) for i in range(count)])
+        self.read()
+        self.assertEqual(len(self.messages), count)
+
+    def test_map_switch_within_block(self):
+        layer = {(1, 305): Handler("layer")}
+        switch = Handler("switch", switch_to=layer)
+        switch.device = self.device
+        self.device._event_map = {(1, 304): switch, (1, 305): Handler("base")}
+        self.write([(1, 0, 1, 304, 1), (1, 0, 1, 305, 1)])
+        self.read()
+        self.assertEqual([msg[0] for msg in self.messages],
+                         ["switch", "layer"])
+
+    def test_end_of_file(self):
+        os.close(self.write_fd)
+        self.write_fd = os.open(os.devnull, os.O_WRONLY)
+        self.assertRaises(OSError, self.read)
+
+class Settings(dict):
+    name = "ABS_X"
+
+class Scheduler(object):
+    def __init__(self):
+        self.callback = None
+        self.sunk = []
+
+    def call_later(self, delay, callback):
+        self.callback = callback
+
+    def sink(self, msg, source=None):
+        self.sunk.append(msg)
+
+@unittest.skipIf(EventDevice is None, "python-evdev not available")
+class PeakScanTimeoutTest(unittest.TestCase):
+    def test_routed(self):
+        device = EventDevice.__new__(EventDevice)
+        device.name = "test"
+        device.scheduler = Scheduler()
+        device.absinfo = {(3, 0): AbsInfo(0, 0, 255, 0, 0, 0)}
+        device.route = None
+        handler = AbsEventHandler(device, (3, 0),
+                                  Settings(trigger="peak", note="38",
+                                           thres_low="10%",
+                                           thres_high="50%"))
+        messages = []
+        device.route = messages.append
+        for value in (0, 200, 220):
+            self.assertIsNone(handler.translate(RawEvent(1, 0, 3, 0,
+                                                         value)))
+        device.scheduler.callback()
+        self.assertEqual(device.scheduler.sunk, [])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual([(msg.note, msg.velocity) for msg in messages[0]],
+                         [(38, 92)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""TimerWheel wakeup tests."""
+
+import asyncio
+import unittest
+
+from badumtss_machine.scheduler import TimerWheel
+
+class CountingWheel(TimerWheel):
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.runs = 0
+
+    def _run(self):
+        self.runs += 1
+        super()._run()
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.wheel = CountingWheel(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_rearm_from_callback(self):
+        """Timers re-armed from callbacks share a single wakeup chain."""
+        calls = []
+        def rearm(i):
+            calls.append(i)
+            self.wheel.call_later(0.01, rearm, i)
+        for i in range(50):
+            self.wheel.call_later(0.01, rearm, i)
+        self.wheel.call_later(1.0, calls.append, "far")
+        self.loop.run_until_complete(asyncio.sleep(0.5))
+        self.assertGreater(len(calls), 50 * 20)
+        # about one wakeup per 10 ms re-arm period
+        self.assertLess(self.wheel.runs, 100)
+
+    def test_far_timer_single_wakeup(self):
+        """A single far timer does not wake the loop every tick."""
+        calls = []
+        self.wheel.call_later(0.2, calls.append, 1)
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertEqual(calls, [1])
+        self.assertLessEqual(self.wheel.runs, 2)
+
+    def test_earlier_timer_moves_wakeup(self):
+        """A timer due sooner than the scheduled wakeup is not delayed."""
+        calls = []
+        self.wheel.call_later(0.3, calls.append, "late")
+        self.wheel.call_later(0.05, lambda: calls.append(
+                                            self.loop.time() - start))
+        start = self.loop.time()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(calls), 1)
+        self.assertLess(calls[0], 0.06)
+
+    def test_cancel(self):
+        calls = []
+        timer = self.wheel.call_later(0.02, calls.append, 1)
+        self.wheel.call_later(0.04, calls.append, 2)
+        timer.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0.06))
+        self.assertEqual(calls, [2])
+        self.assertEqual(self.wheel.pending, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""UdpPlayer tests against a loopback receiver."""
+
+import asyncio
+import socket
+import time
+import unittest
+
+from configparser import ConfigParser
+
+from badumtss_machine import midi
+from badumtss_machine import netproto
+from badumtss_machine.players.udp import UdpPlayer
+
+class UdpPlayerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.settimeout(1.0)
+        config = ConfigParser()
+        config["udp"] = {"address": "127.0.0.1:{}".format(
+                                            self.receiver.getsockname()[1])}
+        self.player = UdpPlayer(config, "udp", self.loop)
+        self.player.start()
+
+    def tearDown(self):
+        self.player.stop()
+        self.receiver.close()
+        self.loop.close()
+
+    def run_loop(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def receive(self):
+        data = self.receiver.recv(netproto.MAX_PACKET_SIZE)
+        header = netproto.decode_header(data)
+        self.assertEqual(header.record_type, netproto.RECORD_MIDI)
+        return header, list(netproto.iter_midi_records(data, header))
+
+    def test_messages_in_one_packet(self):
+        now = time.time()
+        msgs = [midi.NoteOn(10, 38, 100, now - 0.002),
+                midi.ControlChange(10, 4, 90, now - 0.001),
+                midi.NoteOff(10, 38, 0)]
+        for msg in msgs:
+            self.player.handle_message(msg)
+        self.run_loop()
+        header, records = self.receive()
+        self.assertEqual(header.count, 3)
+        self.assertEqual([midi_bytes for offset, midi_bytes in records],
+                         [msg.get_bytes() for msg in msgs])
+        self.assertAlmostEqual(header.send_time + records[0][0], now - 0.002,
+                               delta=0.0001)
+        self.assertLessEqual(records[2][0], 0)
+        self.assertEqual(self.player.messages_sent, 3)
+        self.assertGreaterEqual(self.player.latency_max, 0.002)
+
+    def test_sequence_numbers(self):
+        seqs = []
+        for i in range(3):
+            self.player.handle_message(midi.NoteOn(1, 60 + i, 100))
+            self.run_loop()
+            seqs.append(self.receive()[0].seq)
+        self.assertEqual(seqs, [seqs[0], seqs[0] + 1, seqs[0] + 2])
+
+    def test_full_packet(self):
+        for i in range(netproto.MAX_RECORDS + 1):
+            self.player.handle_message(midi.NoteOn(1, i & 0x7f, 100))
+        self.run_loop()
+        self.assertEqual(self.receive()[0].count, netproto.MAX_RECORDS)
+        self.assertEqual(self.receive()[0].count, 1)
+
+    def test_offset_clamped(self):
+        now = time.time()
+        self.player.handle_message(midi.NoteOn(1, 60, 100, now + 3600))
+        self.player.handle_message(midi.NoteOn(1, 61, 100, now - 3600))
+        self.run_loop()
+        header, records = self.receive()
+        self.assertEqual(records[0][0], 0x7fffffff * 1e-6)
+        self.assertEqual(records[1][0], -0x80000000 * 1e-6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark of evdev input event decoding.
+
+Compares `EventDevice.read_events()` (os.readv() into a reusable buffer,
+struct decoding, objects only for the mapped events) with reading
+through python-evdev and `evdev.categorize()`, as done before.
+
+The input is a gamepad-like stream: each report has 4 unmapped axis
+events, 1 mapped button event and a SYN. Run from the source tree:
+
+    python3 tools/bench_evdev_read.py [--reports N] [--runs N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import evdev
+from evdev import ecodes
+from evdev.events import InputEvent
+
+from badumtss_machine.input.evdev import EventDevice, INPUT_EVENT, READ_EVENTS
+
+REPORT = [(ecodes.EV_ABS, ecodes.ABS_X, 120),
+          (ecodes.EV_ABS, ecodes.ABS_Y, 130),
+          (ecodes.EV_ABS, ecodes.ABS_RX, 10),
+          (ecodes.EV_ABS, ecodes.ABS_RY, 200),
+          (ecodes.EV_KEY, ecodes.BTN_A, 1),
+          (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+
+class Handler(object):
+    """Stand-in for an event handler, only reads the timestamp."""
+    def translate(self, event):
+        event.event.timestamp()
+        return None
+
+class Counter(object):
+    def inc(self, value=1):
+        pass
+
+EVENT_MAP = {(ecodes.EV_KEY, ecodes.BTN_A): Handler(),
+             (ecodes.EV_KEY, ecodes.BTN_B): Handler()}
+
+def read_categorize(fd):
+    """Read events with python-evdev and categorize them."""
+    while True:
+        try:
+            events = evdev._input.device_read_many(fd)
+        except BlockingIOError:
+            return
+        if not events:
+            return
+        for raw_event in events:
+            event = InputEvent(*raw_event)
+            key = (event.type, event.code)
+            event = evdev.categorize(event)
+            handler = EVENT_MAP.get(key)
+            if handler is not None:
+                handler.translate(event)
+
+def make_event_device(fd):
+    """Build EventDevice with just the state read_events() uses."""
+    device = EventDevice.__new__(EventDevice)
+    device.device = type("Device", (), {"fd": fd})()
+    device._buffer = bytearray(INPUT_EVENT.size * READ_EVENTS)
+    device._view = memoryview(device._buffer)
+    device.events_metric = Counter()
+    device._event_map = EVENT_MAP
+    return device
+
+def read_struct(fd):
+    """Read events with EventDevice.read_events()."""
+    try:
+        make_event_device(fd).read_events(lambda msg: None)
+    except OSError:
+        # end of the file
+        pass
+
+def bench(func, path, runs):
+    """Return the best time of `runs` calls of `func` on `path`."""
+    best = None
+    for i in range(runs):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            start = time.perf_counter()
+            func(fd)
+            duration = time.perf_counter() - start
+        finally:
+            os.close(fd)
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--reports", type=int, default=1000,
+                        help="number of reports in the input")
+    parser.add_argument("--runs", type=int, default=20,
+                        help="runs of each variant, the best one counts")
+    args = parser.parse_args()
+    data = b"".join(INPUT_EVENT.pack(1, 2, ev_type, code, value)
+                    for ev_type, code, value in REPORT) * args.reports
+    count = len(data) // INPUT_EVENT.size
+    with tempfile.NamedTemporaryFile(prefix="badumtss-bench-") as events:
+        events.write(data)
+        events.flush()
+        print("{} events, best of {} runs".format(count, args.runs))
+        results = []
+        for name, func in (("python-evdev read() + categorize()",
+                            read_categorize),
+                           ("EventDevice.read_events()", read_struct)):
+            duration = bench(func, events.name, args.runs)
+            results.append(duration)
+            print("  {:36} {:7.3f} us/event".format(name,
+                                                    duration / count * 1e6))
+    print("  speedup: {:.2f}x".format(results[0] / results[1]))
+
+if __name__ == "__main__":
+    main()